@@ -34,15 +34,33 @@ sys.stderr = StreamToLogger(logger, logging.ERROR)
 
 print("--- Application stdout/stderr redirected to app_run.log ---")
 
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response
 from flask_mqtt import Mqtt
 import requests
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import calendar
+import sqlite3
+import gzip
 import os
 import json
+import math
+import hashlib
+import csv
+import io
 from dotenv import load_dotenv
 import pytz
 import threading
+import atexit
+import signal
+from array import array
+import time
+import heapq
+import struct
+import functools
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from savings import np, calculate_savings, calculate_savings_columns
 
 load_dotenv()
 
@@ -87,19 +105,432 @@ with app.app_context():
 SMHI_BASE_URL = "https://opendata-download-metfcst.smhi.se/api"
 VANERSBORG_COORDS = "12.3167,58.3833"  # Vänersborg coordinates
 
-# Cache for weather data
+WEATHER_CACHE_FILE = 'weather_cache.json'
+WEATHER_CACHE_TTL = 3600  # Seconds before the forecast is refreshed in the background
+WEATHER_RETRY_DELAY = 60  # Minimum seconds between refresh attempts after a failure
+
+# Cache for weather data. A stale forecast is served while a single background
+# refresh runs; the cache is saved to disk so a restart has a forecast right away.
 weather_cache = {
     'timestamp': None,
-    'data': None,
-    'location': None
+    'data': None,  # Parsed forecast timeline, see parse_smhi_forecast
+    'location': None,
+    'refreshing': None,  # threading.Event while a refresh is running
+    'last_attempt': None,
+    'aligned': {},  # Forecasts resampled onto price slots, cleared when the forecast changes
+    'responses': {}  # Serialized /api/weather responses, cleared when the forecast changes
 }
+weather_cache_lock = threading.Lock()
 
 # Temperature and energy data storage
-class DataStorage:
-    def __init__(self, filename='temperature_data.json', max_days=30):
+HISTORY_BACKEND = os.getenv('HISTORY_BACKEND', 'sqlite')  # 'sqlite' or 'json'
+HISTORY_CHANGE_LOG_SIZE = 10000  # Changed rows remembered for ?since= polling
+HISTORY_FLUSH_INTERVAL = int(os.getenv('HISTORY_FLUSH_INTERVAL', 30))  # Seconds between writes, 0 writes every change at once
+HISTORY_SAVINGS_FIELDS = ['target_temp', 'optimal_state', 'energy_saved', 'solar_benefit']  # Derived when a record is written
+HISTORY_FIELDS = ['timestamp', 'indoor_temp', 'outdoor_temp', 'roller_position',
+                  'electricity_price', 'solar_production'] + HISTORY_SAVINGS_FIELDS
+HISTORY_FLOAT_FIELDS = ['indoor_temp', 'outdoor_temp', 'electricity_price', 'solar_production',
+                        'target_temp', 'energy_saved', 'solar_benefit']  # float32 columns
+# Text fields stored as small integer codes, -1 when missing. The codes listed here
+# are fixed; other strings get the next free code the first time they are seen.
+HISTORY_CODES = {
+    # Shelly state from MQTT (on/off) and the roller position of the hourly task (open/closed)
+    'roller_position': {'closed': 0, 'open': 1, 'off': 2, 'on': 3, 'unknown': 4},
+    'optimal_state': {'off': 0, 'on': 1}
+}
+HISTORY_CODE_NAMES = {field: {code: name for name, code in codes.items()} for field, codes in HISTORY_CODES.items()}
+HISTORY_CODE_LIMIT = 127  # Largest code an int8 column can hold
+# Numeric level of the text fields when aggregated, 1 while the heat pump runs
+HISTORY_CODE_LEVELS = {
+    'roller_position': {'closed': 0, 'open': 1, 'off': 0, 'on': 1},
+    'optimal_state': {'off': 0, 'on': 1}
+}
+history_codes_lock = threading.Lock()
+
+def history_code(field, name):
+    """Code of a text value, adding new strings to the code table"""
+    codes = HISTORY_CODES[field]
+    code = codes.get(name)
+    if code is None:
+        with history_codes_lock:
+            code = codes.get(name)
+            if code is None:
+                code = len(codes)
+                if code > HISTORY_CODE_LIMIT:
+                    print(f"History: no free code for {field} value {name!r}, stored as unknown")
+                    return codes.get('unknown', -1)
+                codes[name] = code
+                HISTORY_CODE_NAMES[field][code] = name
+    return code
+
+def encode_history_value(field, value):
+    """Column value for a record value: a code for text fields, NaN for missing numbers"""
+    if field in HISTORY_CODES:
+        return -1 if value is None else history_code(field, str(value))
+    return float('nan') if value is None else value
+
+def history_value(columns, field, index):
+    """Record value at index of a column, the inverse of encode_history_value"""
+    value = columns[field][index]
+    if field in HISTORY_CODES:
+        return HISTORY_CODE_NAMES[field].get(value)
+    return None if value != value else value  # NaN marks a missing value
+
+HISTORY_SAVINGS_INPUTS = ['indoor_temp', 'outdoor_temp', 'roller_position', 'electricity_price', 'solar_production']
+
+def recorded_value(columns, field, index):
+    """Value as it was recorded: stored floats are read back as their shortest decimal,
+    so the savings policy sees 3.89 and not the float32 3.8900001049"""
+    value = history_value(columns, field, index)
+    return compact_float(value) if isinstance(value, float) else value
+
+def derive_savings(columns, index, record=None):
+    """Compute the savings columns of one row from its measurements.
+    Values in record are used as given, the others are read from the columns."""
+    savings = calculate_savings(*[
+        record[field] if record is not None and field in record else recorded_value(columns, field, index)
+        for field in HISTORY_SAVINGS_INPUTS
+    ]) or (None, None, None, None)
+    for field, value in zip(HISTORY_SAVINGS_FIELDS, savings):
+        columns[field][index] = encode_history_value(field, value)
+
+def derive_savings_range(columns, start, end):
+    """derive_savings for rows start..end, in one vectorized pass when numpy is installed"""
+    if np is None:
+        for index in range(start, end):
+            derive_savings(columns, index)
+        return
+    if start >= end:
+        return
+    
+    def floats(field):
+        # Shortest decimals like recorded_value, computed once per distinct value
+        values = np.frombuffer(columns[field], dtype=np.float32)[start:end]
+        distinct, inverse = np.unique(values, return_inverse=True)
+        decimals = np.array([compact_float(value) for value in distinct.astype(np.float64).tolist()], dtype=np.float64)
+        return decimals[inverse.reshape(-1)]
+    
+    # Names for the codes -1..127, -1 (missing) is None
+    roller_names = np.array([HISTORY_CODE_NAMES['roller_position'].get(code)
+                             for code in range(-1, HISTORY_CODE_LIMIT + 1)], dtype=object)
+    roller_codes = np.frombuffer(columns['roller_position'], dtype=np.int8)[start:end].astype(np.int64)
+    savings = calculate_savings_columns(
+        floats('indoor_temp'),
+        floats('outdoor_temp'),
+        roller_names[roller_codes + 1],
+        floats('electricity_price'),
+        floats('solar_production')
+    )
+    for field in HISTORY_SAVINGS_FIELDS:
+        values = savings[field]
+        if field in HISTORY_CODES:
+            names = values
+            values = np.full(len(names), -1, dtype=np.int8)
+            for name, code in HISTORY_CODES[field].items():
+                values[names == name] = code
+        else:
+            values = values.astype(np.float32)
+        column = array(columns[field].typecode)
+        column.frombytes(values.tobytes())
+        columns[field][start:end] = column
+
+def history_time(timestamp):
+    """Wall-clock timestamp string to seconds, counted as if the local time were UTC.
+    This keeps the conversion exact in both directions, also around DST changes."""
+    return calendar.timegm(datetime.fromisoformat(timestamp).timetuple())
+
+def history_timestamp(seconds):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+FLOAT32 = struct.Struct('<f')
+
+@functools.lru_cache(maxsize=8192)
+def compact_float(value):
+    """Shortest decimal that reads back as the same float32, so 21.3 stays 21.3"""
+    for digits in (6, 7, 8):
+        candidate = float(f'{value:.{digits}g}')
+        if FLOAT32.unpack(FLOAT32.pack(candidate))[0] == value:
+            return candidate
+    return float(f'{value:.9g}')
+
+def history_rows(columns):
+    """Turn column slices from DataStorage.get_columns into record dicts"""
+    times = columns['time']
+    fields = [field for field in columns if field != 'time']
+    rows = []
+    for i in range(len(times)):
+        row = {'timestamp': history_timestamp(times[i])}
+        for field in fields:
+            value = history_value(columns, field, i)
+            row[field] = compact_float(value) if isinstance(value, float) else value
+        rows.append(row)
+    return rows
+
+# Running totals per day and month, kept as lists in this order
+HISTORY_AGGREGATE_FIELDS = ['records', 'energy_saved', 'solar_benefit', 'on_hours',
+                            'indoor_sum', 'indoor_count', 'outdoor_sum', 'outdoor_count', 'cost']
+HEATPUMP_KWH_PER_HOUR = 1.5  # Heat pump consumption while running, as assumed by the savings policy
+
+def row_contribution(columns, index):
+    """What one hourly row adds to the running aggregates of its day and month"""
+    def number(field):
+        value = columns[field][index]
+        return 0.0 if value != value else value
+    indoor_temp = columns['indoor_temp'][index]
+    outdoor_temp = columns['outdoor_temp'][index]
+    # The roller position field holds the heat pump state, on or open means running
+    on_hours = HISTORY_CODE_LEVELS['roller_position'].get(history_value(columns, 'roller_position', index), 0)
+    return [
+        1,
+        number('energy_saved'),
+        number('solar_benefit'),
+        on_hours,
+        0.0 if indoor_temp != indoor_temp else indoor_temp,
+        0 if indoor_temp != indoor_temp else 1,
+        0.0 if outdoor_temp != outdoor_temp else outdoor_temp,
+        0 if outdoor_temp != outdoor_temp else 1,
+        on_hours * HEATPUMP_KWH_PER_HOUR * number('electricity_price')
+    ]
+
+def add_aggregate(aggregates, key, contribution, sign=1):
+    """Add (or with sign=-1 subtract) a row contribution to aggregates[key]"""
+    aggregate = aggregates.get(key)
+    if aggregate is None:
+        aggregate = aggregates[key] = [0] * len(HISTORY_AGGREGATE_FIELDS)
+    for i, value in enumerate(contribution):
+        aggregate[i] += sign * value
+    if aggregate[0] == 0:
+        del aggregates[key]
+
+def format_aggregate(period, aggregate):
+    values = dict(zip(HISTORY_AGGREGATE_FIELDS, aggregate))
+    return {
+        'period': period,
+        'records': values['records'],
+        'energy_saved': round(values['energy_saved'], 2),
+        'solar_benefit': round(values['solar_benefit'], 2),
+        'on_hours': values['on_hours'],
+        'avg_indoor_temp': round(values['indoor_sum'] / values['indoor_count'], 2) if values['indoor_count'] else None,
+        'avg_outdoor_temp': round(values['outdoor_sum'] / values['outdoor_count'], 2) if values['outdoor_count'] else None,
+        'cost': round(values['cost'], 2)
+    }
+
+HISTORY_BUCKETS = {'15m': 15 * 60, '1h': 3600, '1d': 86400}
+HISTORY_AGGREGATES = ('mean', 'min', 'max', 'sum', 'last')
+
+def float32_value(value):
+    """Round a computed value to float32 precision and print it like a stored value"""
+    return compact_float(FLOAT32.unpack(FLOAT32.pack(value))[0])
+
+def aggregate_history(columns, fields, bucket_seconds, agg):
+    """Aggregate column slices into buckets of bucket_seconds. Times are wall-clock
+    seconds, so daily buckets start at local midnight. Text fields are aggregated
+    by their HISTORY_CODE_LEVELS (1 for open/on, 0 for closed/off), other values
+    are skipped. Returns columns of lists. Uses one vectorized pass per field when
+    numpy is installed."""
+    if np is not None:
+        return aggregate_history_columns(columns, fields, bucket_seconds, agg)
+    times = columns['time']
+    result = {'time': []}
+    bounds = []
+    i = 0
+    # Bucket edges by binary search, the values are then reduced per slice
+    while i < len(times):
+        bucket_start = times[i] - times[i] % bucket_seconds
+        j = bisect_left(times, bucket_start + bucket_seconds, i)
+        bounds.append((i, j))
+        result['time'].append(history_timestamp(bucket_start))
+        i = j
+    
+    for field in fields:
+        column = columns[field]
+        levels = None
+        if field in HISTORY_CODES:
+            names = HISTORY_CODE_NAMES[field]
+            levels = {code: HISTORY_CODE_LEVELS[field][name] for code, name in names.items()
+                      if name in HISTORY_CODE_LEVELS[field]}
+        values = result[field] = []
+        for i, j in bounds:
+            if levels is None:
+                present = [value for value in column[i:j] if value == value]
+            else:
+                present = [levels[value] for value in column[i:j] if value in levels]
+            if not present:
+                values.append(None)
+            elif agg == 'last':
+                values.append(present[-1])
+            elif agg == 'min':
+                values.append(min(present))
+            elif agg == 'max':
+                values.append(max(present))
+            elif agg == 'sum':
+                values.append(math.fsum(present))
+            else:
+                values.append(math.fsum(present) / len(present))
+        result[field] = [value if value is None else float32_value(value) for value in values]
+    return result
+
+def aggregate_history_columns(columns, fields, bucket_seconds, agg):
+    """aggregate_history with numpy: the bucket edges are found once and every
+    field is reduced over them with reduceat, NaN marking the skipped values"""
+    times = np.frombuffer(columns['time'], dtype=np.int64)
+    result = {'time': []}
+    if not len(times):
+        result.update((field, []) for field in fields)
+        return result
+    bucket_starts = times - times % bucket_seconds
+    edges = np.flatnonzero(np.concatenate(([True], bucket_starts[1:] != bucket_starts[:-1])))
+    result['time'] = [history_timestamp(start) for start in bucket_starts[edges].tolist()]
+    
+    for field in fields:
+        if field in HISTORY_CODES:
+            # Level for each code -1..127, NaN for codes without a level
+            levels = np.full(HISTORY_CODE_LIMIT + 2, np.nan)
+            for code, name in list(HISTORY_CODE_NAMES[field].items()):
+                if name in HISTORY_CODE_LEVELS[field]:
+                    levels[code + 1] = HISTORY_CODE_LEVELS[field][name]
+            values = levels[np.frombuffer(columns[field], dtype=np.int8).astype(np.int64) + 1]
+        else:
+            values = np.frombuffer(columns[field], dtype=np.float32).astype(np.float64)
+        present = ~np.isnan(values)
+        counts = np.add.reduceat(present.astype(np.int64), edges)
+        if agg == 'last':
+            last = np.maximum.reduceat(np.where(present, np.arange(len(values)), -1), edges)
+            reduced = values[np.maximum(last, 0)]
+        elif agg == 'min':
+            reduced = np.fmin.reduceat(values, edges)
+        elif agg == 'max':
+            reduced = np.fmax.reduceat(values, edges)
+        else:
+            reduced = np.add.reduceat(np.where(present, values, 0.0), edges)
+            if agg == 'mean':
+                reduced = reduced / np.maximum(counts, 1)
+        result[field] = [float32_value(value) if count else None
+                         for value, count in zip(reduced.tolist(), counts.tolist())]
+    return result
+
+# Months that have left the hot store, one gzip compressed file per month
+HISTORY_ARCHIVE_DIR = 'history_archive'
+HISTORY_ARCHIVE_HEADER = struct.Struct('<I')  # Row count, followed by one block per column and the code table as JSON
+HISTORY_ARCHIVE_COLUMNS = [
+    ('time', 'q'), ('indoor_temp', 'f'), ('outdoor_temp', 'f'), ('electricity_price', 'f'),
+    ('solar_production', 'f'), ('roller_position', 'b'),
+    # Segments written before the savings columns existed end here
+    ('target_temp', 'f'), ('energy_saved', 'f'), ('solar_benefit', 'f'), ('optimal_state', 'b')
+]
+
+history_archive = {}  # month -> columns, filled on first access
+history_archive_daily = {}  # month -> {day: aggregate} of the archived rows
+history_archive_lock = threading.Lock()
+
+def history_month(seconds):
+    return history_timestamp(seconds)[:7]
+
+def history_month_start(seconds):
+    year, month = time.gmtime(seconds)[:2]
+    return calendar.timegm((year, month, 1, 0, 0, 0))
+
+def history_archive_path(month):
+    return os.path.join(HISTORY_ARCHIVE_DIR, f"{month}.bin.gz")
+
+def history_archive_months():
+    if not os.path.isdir(HISTORY_ARCHIVE_DIR):
+        return []
+    return sorted(name[:7] for name in os.listdir(HISTORY_ARCHIVE_DIR) if name.endswith('.bin.gz'))
+
+def read_history_archive_month(month):
+    """Return the columns of one archived month, empty if there is no segment.
+    Must be called with history_archive_lock held."""
+    cached = history_archive.get(month)
+    if cached is None:
+        cached = history_archive[month] = load_history_archive_month(month)
+    return cached
+
+def load_history_archive_month(month):
+    """Read one segment without caching it"""
+    columns = {name: array(typecode) for name, typecode in HISTORY_ARCHIVE_COLUMNS}
+    path = history_archive_path(month)
+    if os.path.exists(path):
+        with gzip.open(path, 'rb') as f:
+            data = f.read()
+        count, = HISTORY_ARCHIVE_HEADER.unpack_from(data, 0)
+        offset = HISTORY_ARCHIVE_HEADER.size
+        for name, typecode in HISTORY_ARCHIVE_COLUMNS:
+            column = columns[name]
+            size = count * column.itemsize
+            if offset + size > len(data):
+                break
+            column.frombytes(data[offset:offset + size])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            offset += size
+        else:
+            if offset < len(data):
+                # Codes of this segment to the codes of the running app
+                for field, names in json.loads(data[offset:].decode('utf-8')).items():
+                    translate = {code: history_code(field, name) for code, name in enumerate(names)}
+                    if any(code != new_code for code, new_code in translate.items()):
+                        columns[field] = array('b', [translate.get(code, -1) for code in columns[field]])
+            return columns
+        # Older segment without savings columns
+        for name in HISTORY_SAVINGS_FIELDS:
+            columns[name] = array(columns[name].typecode, [encode_history_value(name, None)] * count)
+        derive_savings_range(columns, 0, count)
+    return columns
+
+def read_history_archive_daily(month):
+    """Daily aggregates of one archived month, computed once per segment.
+    Must be called with history_archive_lock held."""
+    daily = history_archive_daily.get(month)
+    if daily is None:
+        columns = read_history_archive_month(month)
+        daily = history_archive_daily[month] = {}
+        for index, seconds in enumerate(columns['time']):
+            add_aggregate(daily, history_timestamp(seconds)[:10], row_contribution(columns, index))
+    return daily
+
+def write_history_archive_month(month, columns):
+    """Write the rows of one month to its segment, merged with rows already archived.
+    Segments are written once when the month leaves the hot store."""
+    with history_archive_lock:
+        archived = read_history_archive_month(month)
+        rows = {}
+        for source in (archived, columns):
+            for i, seconds in enumerate(source['time']):
+                rows[seconds] = [source[name][i] for name, typecode in HISTORY_ARCHIVE_COLUMNS]
+        merged = {name: array(typecode) for name, typecode in HISTORY_ARCHIVE_COLUMNS}
+        for seconds in sorted(rows):
+            for (name, typecode), value in zip(HISTORY_ARCHIVE_COLUMNS, rows[seconds]):
+                merged[name].append(value)
+        
+        blocks = [HISTORY_ARCHIVE_HEADER.pack(len(merged['time']))]
+        for name, typecode in HISTORY_ARCHIVE_COLUMNS:
+            column = array(typecode, merged[name])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            blocks.append(column.tobytes())
+        code_names = {field: [HISTORY_CODE_NAMES[field][code] for code in range(len(HISTORY_CODE_NAMES[field]))]
+                      for field in HISTORY_CODES}
+        blocks.append(json.dumps(code_names).encode('utf-8'))
+        path = history_archive_path(month)
+        os.makedirs(HISTORY_ARCHIVE_DIR, exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as compressed:
+                compressed.write(b''.join(blocks))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        history_archive[month] = merged
+        history_archive_daily.pop(month, None)
+
+class JsonStorageBackend:
+    """Keeps all hourly records in one JSON file, rewritten atomically on every flush"""
+    def __init__(self, filename='temperature_data.json'):
         self.filename = filename
-        self.max_days = max_days
         self.data = self.load_data()
+        self.data['hourly_records'].sort(key=lambda record: record['timestamp'])
+        self.by_timestamp = {record['timestamp']: record for record in self.data['hourly_records']}
     
     def load_data(self):
         try:
@@ -109,38 +540,463 @@ class DataStorage:
             return {'hourly_records': []}
         except Exception as e:
             print(f"Error loading data: {str(e)}")
+            # Keep the unreadable file instead of overwriting it on the next save
+            corrupt_filename = f"{self.filename}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            try:
+                os.replace(self.filename, corrupt_filename)
+                print(f"Moved unreadable history file to {corrupt_filename}")
+            except Exception as move_error:
+                print(f"Error moving unreadable history file: {str(move_error)}")
             return {'hourly_records': []}
     
     def save_data(self):
+        """Write to a temporary file, fsync it and rename it over the old file,
+        so a crash leaves either the old or the new file, never a partial one"""
         try:
-            with open(self.filename, 'w') as f:
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as f:
                 json.dump(self.data, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_filename, self.filename)
             print(f"Data saved to {self.filename}")
             return True
         except Exception as e:
             print(f"Error saving data: {str(e)}")
             return False
     
+    def write_batch(self, records, delete_before=None):
+        for record in records:
+            self.apply_record(record)
+        if delete_before:
+            self.apply_delete_before(delete_before)
+        if not self.save_data():
+            raise IOError(f"Could not save {self.filename}")
+    
+    def apply_record(self, record):
+        existing = self.by_timestamp.get(record['timestamp'])
+        if existing is not None:
+            existing.update(record)
+        else:
+            record = dict(record)
+            self.by_timestamp[record['timestamp']] = record
+            self.data['hourly_records'].append(record)
+            if len(self.data['hourly_records']) > 1 and self.data['hourly_records'][-2]['timestamp'] > record['timestamp']:
+                self.data['hourly_records'].sort(key=lambda item: item['timestamp'])
+    
+    def load_records(self, start_timestamp):
+        return [dict(record) for record in self.data['hourly_records']
+                if record['timestamp'] >= start_timestamp]
+    
+    def apply_delete_before(self, timestamp):
+        records = self.data['hourly_records']
+        count = bisect_left([record['timestamp'] for record in records], timestamp)
+        for record in records[:count]:
+            del self.by_timestamp[record['timestamp']]
+        del records[:count]
+
+class SqliteStorageBackend:
+    """Keeps hourly records in SQLite (WAL mode), one row per hour keyed by timestamp.
+    Upserts and range queries use the primary key index, so their cost does not
+    grow with the length of the history."""
+    def __init__(self, filename='temperature_data.db', migrate_from='temperature_data.json'):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS hourly_records (
+                    timestamp TEXT PRIMARY KEY,
+                    indoor_temp REAL,
+                    outdoor_temp REAL,
+                    roller_position TEXT,
+                    electricity_price REAL,
+                    solar_production REAL,
+                    target_temp REAL,
+                    optimal_state TEXT,
+                    energy_saved REAL,
+                    solar_benefit REAL
+                ) WITHOUT ROWID""")
+            # Databases created before the savings columns
+            existing = {row['name'] for row in self.conn.execute('PRAGMA table_info(hourly_records)')}
+            for field, column_type in (('target_temp', 'REAL'), ('optimal_state', 'TEXT'),
+                                       ('energy_saved', 'REAL'), ('solar_benefit', 'REAL')):
+                if field not in existing:
+                    self.conn.execute(f'ALTER TABLE hourly_records ADD COLUMN {field} {column_type}')
+            self.conn.commit()
+        if migrate_from:
+            self.migrate_json(migrate_from)
+    
+    def migrate_json(self, json_filename):
+        """One-time import of the old JSON history file"""
+        if not os.path.exists(json_filename):
+            return
+        with self.lock:
+            if self.conn.execute('SELECT COUNT(*) FROM hourly_records').fetchone()[0] > 0:
+                return
+        records = JsonStorageBackend(json_filename).data.get('hourly_records', [])
+        try:
+            with self.lock, self.conn:
+                self.conn.executemany(self.upsert_sql(), [
+                    tuple(record.get(field) for field in HISTORY_FIELDS) for record in records])
+            os.replace(json_filename, json_filename + '.migrated')
+            print(f"Migrated {len(records)} records from {json_filename} to {self.filename}")
+        except Exception as e:
+            print(f"Error migrating {json_filename}: {str(e)}")
+    
+    def upsert_sql(self, fields=HISTORY_FIELDS):
+        """Insert a row or update the given fields of an existing one"""
+        columns = ', '.join(fields)
+        placeholders = ', '.join('?' for _ in fields)
+        updates = ', '.join(f"{field} = excluded.{field}" for field in fields[1:])
+        return (f"INSERT INTO hourly_records ({columns}) VALUES ({placeholders}) "
+                f"ON CONFLICT(timestamp) DO {'UPDATE SET ' + updates if updates else 'NOTHING'}")
+    
+    def write_batch(self, records, delete_before=None):
+        """Write several records (and a retention delete) in one transaction.
+        Records may be partial, only the fields they carry are written."""
+        batches = {}
+        for record in records:
+            fields = tuple(field for field in HISTORY_FIELDS if field in record)
+            batches.setdefault(fields, []).append(tuple(record[field] for field in fields))
+        with self.lock, self.conn:
+            for fields, rows in batches.items():
+                self.conn.executemany(self.upsert_sql(fields), rows)
+            if delete_before:
+                self.conn.execute('DELETE FROM hourly_records WHERE timestamp < ?', (delete_before,))
+    
+    def load_records(self, start_timestamp):
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(HISTORY_FIELDS)} FROM hourly_records "
+                "WHERE timestamp >= ? ORDER BY timestamp", (start_timestamp,)).fetchall()
+        return [dict(row) for row in rows]
+
+def create_storage_backend(name=HISTORY_BACKEND):
+    if name == 'json':
+        return JsonStorageBackend()
+    return SqliteStorageBackend()
+
+class DataStorage:
+    """Hourly history. The records within max_days are kept in memory as columns:
+    an int64 array of times plus a float32 array per measurement and a small int
+    array for the roller position, all sorted by time. Upserts of the latest hour
+    are O(1), other lookups and range reads are a binary search plus array slices,
+    and record dicts are only built at the JSON boundary.
+    Whole months older than max_days are rotated into compressed archive segments,
+    which range reads load lazily when they reach back that far.
+    Changes are written behind: they are collected as pending writes and a flusher
+    thread persists them at most every flush_interval seconds, and on shutdown."""
+    def __init__(self, backend=None, max_days=30, flush_interval=HISTORY_FLUSH_INTERVAL):
+        self.backend = backend or create_storage_backend()
+        self.filename = self.backend.filename
+        self.max_days = max_days
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.pending = {}  # timestamp -> record waiting to be written
+        self.pending_delete_before = None
+        self.metrics = {
+            'flushes': 0,
+            'flush_errors': 0,
+            'last_flush': None,
+            'last_flush_ms': None,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0
+        }
+        self.closed = threading.Event()
+        self.version = 0  # Increased on every change of the stored rows
+        # (version, time) of recently changed rows; changes at or below changes_floor are not in it
+        self.changes = deque(maxlen=HISTORY_CHANGE_LOG_SIZE)
+        self.changes_floor = 0
+        self.started = int(time.time())  # Cursors from an earlier run are not valid
+        # Running aggregates of the hot rows, 'YYYY-MM-DD' and 'YYYY-MM' -> HISTORY_AGGREGATE_FIELDS values
+        self.daily = {}
+        self.monthly = {}
+        self.times = array('q')
+        self.columns = {field: array('f') for field in HISTORY_FLOAT_FIELDS}
+        for field in HISTORY_CODES:
+            self.columns[field] = array('b')
+        for record in self.backend.load_records(''):
+            self.set_row(history_time(record['timestamp']), record)
+        # Archive months that aged out while the app was not running
+        self.rotate((datetime.now() - timedelta(days=max_days)).strftime("%Y-%m-%d %H:00:00"))
+        self.changes.clear()
+        self.changes_floor = self.version
+        
+        if self.flush_interval > 0:
+            threading.Thread(target=self.run_flusher, daemon=True, name='history-flusher').start()
+    
+    def find(self, seconds):
+        """Array index of the row for seconds, or None"""
+        times = self.times
+        if times and times[-1] == seconds:
+            return len(times) - 1
+        index = bisect_left(times, seconds)
+        if index < len(times) and times[index] == seconds:
+            return index
+        return None
+    
+    def set_row(self, seconds, record):
+        """Write the fields of record into the row for seconds, adding the row if needed.
+        The savings columns are derived unless the record already carries them.
+        Increases the version if anything changed. Returns the array index of the row."""
+        index = self.find(seconds)
+        old_contribution = None
+        if index is not None:
+            old_contribution = row_contribution(self.columns, index)
+            changed = False
+            for field, column in self.columns.items():
+                if field in record:
+                    old_value = column[index]
+                    column[index] = encode_history_value(field, record[field])
+                    if column[index] != old_value and not (old_value != old_value and column[index] != column[index]):
+                        changed = True
+            if not changed:
+                return index
+        elif self.times and seconds < self.times[-1]:
+            # Out-of-order insert
+            index = bisect_left(self.times, seconds)
+            self.times.insert(index, seconds)
+            for field, column in self.columns.items():
+                column.insert(index, encode_history_value(field, record.get(field)))
+        else:
+            index = len(self.times)
+            self.times.append(seconds)
+            for field, column in self.columns.items():
+                column.append(encode_history_value(field, record.get(field)))
+        
+        if record.get('energy_saved') is None:
+            derive_savings(self.columns, index, record)
+        if old_contribution is not None:
+            self.add_to_aggregates(seconds, old_contribution, -1)
+        self.add_to_aggregates(seconds, row_contribution(self.columns, index))
+        self.version += 1
+        if len(self.changes) == self.changes.maxlen:
+            self.changes_floor = self.changes[0][0]
+        self.changes.append((self.version, seconds))
+        return index
+    
+    def add_to_aggregates(self, seconds, contribution, sign=1):
+        day = history_timestamp(seconds)[:10]
+        add_aggregate(self.daily, day, contribution, sign)
+        add_aggregate(self.monthly, day[:7], contribution, sign)
+    
+    def rebuild_aggregates(self):
+        self.daily = {}
+        self.monthly = {}
+        for index, seconds in enumerate(self.times):
+            self.add_to_aggregates(seconds, row_contribution(self.columns, index))
+    
+    def get_aggregates(self, start_day, end_day, by='day'):
+        """Aggregates per day or month for start_day <= day <= end_day ('YYYY-MM-DD').
+        Months fully inside the range come from the monthly totals, everything else
+        from the daily ones, so the cost depends on the number of days, not records.
+        Days before the hot store are aggregated from the archive once per segment.
+        Returns a sorted list of (period, aggregate values)."""
+        periods = {}
+        def add(period, aggregate):
+            total = periods.setdefault(period, [0] * len(HISTORY_AGGREGATE_FIELDS))
+            for i, value in enumerate(aggregate):
+                total[i] += value
+        
+        def whole_month(month):
+            year, number = int(month[:4]), int(month[5:7])
+            last_day = calendar.monthrange(year, number)[1]
+            return start_day <= f"{month}-01" and f"{month}-{last_day:02d}" <= end_day
+        
+        with self.lock:
+            hot_start_day = history_timestamp(self.times[0])[:10] if self.times else None
+            whole_months = {month for month in self.monthly if by == 'month' and whole_month(month)}
+            for month in whole_months:
+                add(month, self.monthly[month])
+            for day, aggregate in self.daily.items():
+                if start_day <= day <= end_day:
+                    if day[:7] in whole_months:
+                        continue  # Already counted in the monthly total
+                    add(day[:7] if by == 'month' else day, aggregate)
+        
+        if hot_start_day is None or start_day < hot_start_day:
+            with history_archive_lock:
+                for month in history_archive_months():
+                    if month < start_day[:7] or month > end_day[:7]:
+                        continue
+                    for day, aggregate in read_history_archive_daily(month).items():
+                        if start_day <= day <= end_day and (hot_start_day is None or day < hot_start_day):
+                            add(day[:7] if by == 'month' else day, aggregate)
+        return sorted(periods.items())
+    
+    def get_totals(self, start_day, end_day):
+        """Formatted aggregate over all days from start_day to end_day"""
+        total = [0] * len(HISTORY_AGGREGATE_FIELDS)
+        for period, aggregate in self.get_aggregates(start_day, end_day, by='month'):
+            for i, value in enumerate(aggregate):
+                total[i] += value
+        return format_aggregate(f"{start_day}/{end_day}", total)
+    
+    def upsert(self, record):
+        """Insert or update the record for record['timestamp']"""
+        seconds = history_time(record['timestamp'])
+        with self.lock:
+            version = self.version
+            index = self.set_row(seconds, record)
+            if self.version == version:
+                return  # Nothing changed
+            # The backend gets the values as recorded, float32 is only the in-memory form.
+            # Fields the record does not carry are left as they are in the backend.
+            row = self.pending.setdefault(record['timestamp'], {})
+            row.update((field, value) for field, value in record.items() if field in HISTORY_FIELDS)
+            if record.get('energy_saved') is None:
+                row.update(history_rows(self.get_columns_at(index, index + 1, HISTORY_SAVINGS_FIELDS))[0])
+        if self.flush_interval <= 0:
+            self.flush()
+    
+    def trim(self, before_timestamp):
+        """Drop records older than before_timestamp"""
+        with self.lock:
+            count = bisect_left(self.times, history_time(before_timestamp))
+            if count:
+                for index in range(count):
+                    self.add_to_aggregates(self.times[index], row_contribution(self.columns, index), -1)
+                del self.times[:count]
+                for column in self.columns.values():
+                    del column[:count]
+                self.version += 1
+            for key in [key for key in self.pending if key < before_timestamp]:
+                del self.pending[key]
+            self.pending_delete_before = max(self.pending_delete_before or '', before_timestamp)
+        if self.flush_interval <= 0:
+            self.flush()
+    
+    def recompute_savings(self):
+        """Derive the savings columns again for the whole history, in memory, in the
+        backend and in the archive. Used after the savings policy has changed.
+        Returns the number of hot and archived rows."""
+        # The hot rows are derived from the values as recorded in the backend,
+        # the archive only has its float32 columns
+        self.flush()
+        with self.lock:
+            recorded = {record['timestamp']: record for record in self.backend.load_records('')}
+            for timestamp, row in self.pending.items():
+                recorded.setdefault(timestamp, {}).update(row)
+            for index, seconds in enumerate(self.times):
+                record = recorded.get(history_timestamp(seconds), {})
+                derive_savings(self.columns, index, {field: record[field] for field in HISTORY_SAVINGS_INPUTS
+                                                     if field in record})
+            self.rebuild_aggregates()
+            self.version += 1
+            # Every row changed, clients have to reload
+            self.changes.clear()
+            self.changes_floor = self.version
+            for row in history_rows(self.get_columns_at(0, len(self.times), HISTORY_SAVINGS_FIELDS)):
+                self.pending.setdefault(row['timestamp'], {}).update(row)
+            hot_count = len(self.times)
+        
+        archived_count = 0
+        for month in history_archive_months():
+            with history_archive_lock:
+                columns = load_history_archive_month(month)
+            derive_savings_range(columns, 0, len(columns['time']))
+            write_history_archive_month(month, columns)
+            archived_count += len(columns['time'])
+        
+        self.flush()
+        return hot_count, archived_count
+    
+    def rotate(self, before_timestamp):
+        """Move the whole months before the month of before_timestamp into archive
+        segments and drop them from the hot store and the backend"""
+        month_start = history_month_start(history_time(before_timestamp))
+        with self.lock:
+            count = bisect_left(self.times, month_start)
+            if not count:
+                return
+            try:
+                start_index = 0
+                while start_index < count:
+                    month = history_month(self.times[start_index])
+                    next_month = history_month_start(history_month_start(self.times[start_index]) + 32 * 86400)
+                    end_index = bisect_left(self.times, next_month, start_index, count)
+                    write_history_archive_month(month, self.get_columns_at(start_index, end_index))
+                    print(f"Archived {end_index - start_index} history records for {month}")
+                    start_index = end_index
+            except Exception as e:
+                # Keep the rows in the hot store and try again with the next hour
+                print(f"Error archiving history: {str(e)}")
+                return
+            self.trim(history_timestamp(month_start))
+    
+    def flush(self):
+        """Write all pending changes to the backend in one batch"""
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending and not self.pending_delete_before:
+                    return True
+                records = list(self.pending.values())
+                delete_before = self.pending_delete_before
+                self.pending = {}
+                self.pending_delete_before = None
+            
+            started = time.perf_counter()
+            try:
+                self.backend.write_batch(records, delete_before)
+            except Exception as e:
+                print(f"Error flushing history data: {str(e)}")
+                with self.lock:
+                    # Keep the changes for the next attempt, newer versions win
+                    for record in records:
+                        self.pending.setdefault(record['timestamp'], record)
+                    if delete_before:
+                        self.pending_delete_before = max(self.pending_delete_before or '', delete_before)
+                self.metrics['flush_errors'] += 1
+                return False
+            
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.metrics['flushes'] += 1
+            self.metrics['last_flush'] = datetime.now()
+            self.metrics['last_flush_ms'] = elapsed_ms
+            self.metrics['max_flush_ms'] = max(self.metrics['max_flush_ms'], elapsed_ms)
+            self.metrics['total_flush_ms'] += elapsed_ms
+            return True
+    
+    def run_flusher(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+    
+    def close(self):
+        """Stop the flusher and write everything still pending"""
+        self.closed.set()
+        self.flush()
+    
+    def get_metrics(self):
+        with self.lock:
+            pending_writes = len(self.pending) + (1 if self.pending_delete_before else 0)
+            records_in_memory = len(self.times)
+        flushes = self.metrics['flushes']
+        return {
+            'backend': type(self.backend).__name__,
+            'filename': self.filename,
+            'records_in_memory': records_in_memory,
+            'pending_writes': pending_writes,
+            'flush_interval': self.flush_interval,
+            'flushes': flushes,
+            'flush_errors': self.metrics['flush_errors'],
+            'last_flush': self.metrics['last_flush'].isoformat() if self.metrics['last_flush'] else None,
+            'last_flush_ms': round(self.metrics['last_flush_ms'], 3) if self.metrics['last_flush_ms'] is not None else None,
+            'max_flush_ms': round(self.metrics['max_flush_ms'], 3),
+            'avg_flush_ms': round(self.metrics['total_flush_ms'] / flushes, 3) if flushes else None
+        }
+    
     def add_hourly_record(self, indoor_temp, outdoor_temp, roller_position, electricity_price, solar_production=0):
         now = datetime.now()
         timestamp = now.strftime("%Y-%m-%d %H:00:00")  # Round to the hour
+        with self.lock:
+            is_new_hour = self.find(history_time(timestamp)) is None
         
-        # Check if we already have a record for this hour
-        for record in self.data['hourly_records']:
-            if record['timestamp'] == timestamp:
-                # Update existing record
-                record.update({
-                    'indoor_temp': indoor_temp,
-                    'outdoor_temp': outdoor_temp,
-                    'roller_position': roller_position,
-                    'electricity_price': electricity_price,
-                    'solar_production': solar_production
-                })
-                self.save_data()
-                return
-        
-        # Add new record
-        self.data['hourly_records'].append({
+        self.upsert({
             'timestamp': timestamp,
             'indoor_temp': indoor_temp,
             'outdoor_temp': outdoor_temp,
@@ -149,24 +1005,377 @@ class DataStorage:
             'solar_production': solar_production
         })
         
-        # Remove old records (keep only max_days)
-        if len(self.data['hourly_records']) > self.max_days * 24:
-            self.data['hourly_records'] = self.data['hourly_records'][-(self.max_days * 24):]
+        # Archive old months (the hot store keeps at least max_days)
+        if is_new_hour:
+            self.rotate((now - timedelta(days=self.max_days)).strftime("%Y-%m-%d %H:00:00"))
+    
+    def get_cursor(self):
+        """Cursor for get_changes, marking the current version"""
+        with self.lock:
+            return f"{self.started}-{self.version}"
+    
+    def get_changes(self, cursor, start=None):
+        """Rows added or changed after cursor, with time >= start.
+        Returns (rows, new cursor), or None when the changes since cursor are no
+        longer known (bad cursor, restart, log overflow) and the client must reload."""
+        try:
+            started, since = (int(part) for part in cursor.split('-'))
+        except (AttributeError, ValueError):
+            return None
+        start_seconds = history_time(start) if start else None
+        with self.lock:
+            if started != self.started or since < self.changes_floor or since > self.version:
+                return None
+            changed = set()
+            for version, seconds in reversed(self.changes):
+                if version <= since:
+                    break
+                if start_seconds is None or seconds >= start_seconds:
+                    changed.add(seconds)
+            indexes = sorted(index for index in map(self.find, changed) if index is not None)
+            columns = {'time': array('q', (self.times[index] for index in indexes))}
+            for name, column in self.columns.items():
+                columns[name] = array(column.typecode, (column[index] for index in indexes))
+            cursor = f"{self.started}-{self.version}"
+        return history_rows(columns), cursor
+    
+    def get_columns_at(self, start_index, end_index, fields=None):
+        columns = {'time': self.times[start_index:end_index]}
+        for field in fields or self.columns:
+            columns[field] = self.columns[field][start_index:end_index]
+        return columns
+    
+    def get_columns(self, start=None, end=None, fields=None):
+        """Array slices of the rows with start <= time < end (timestamp strings,
+        None for open ends), keyed 'time' plus the requested fields.
+        An open start includes every archived month."""
+        start_seconds = history_time(start) if start else 0
+        end_seconds = history_time(end) if end else None
+        with self.lock:
+            start_index = bisect_left(self.times, start_seconds)
+            end_index = bisect_left(self.times, end_seconds) if end else len(self.times)
+            columns = self.get_columns_at(start_index, end_index, fields)
+            hot_start = self.times[0] if self.times else None
+        
+        if hot_start is None or start_seconds < hot_start:
+            columns = self.get_archived_columns(start_seconds, end_seconds, hot_start, columns)
+        return columns
+    
+    def iter_columns(self, start=None, end=None, chunk_size=1000):
+        """Yield column chunks of at most chunk_size rows with start <= time < end,
+        first from the archive and then from the hot store. Segments that are not
+        cached are read without caching them, so memory stays flat for any range."""
+        cursor = history_time(start) if start else 0
+        end_seconds = history_time(end) if end else None
+        with self.lock:
+            hot_start = self.times[0] if self.times else None
+        limits = [value for value in (end_seconds, hot_start) if value is not None]
+        limit = min(limits) if limits else None
+        
+        for month in history_archive_months():
+            if month < history_month(cursor):
+                continue
+            if limit is not None and month > history_month(limit):
+                break
+            with history_archive_lock:
+                archived = history_archive.get(month) or load_history_archive_month(month)
+            start_index = bisect_left(archived['time'], cursor)
+            end_index = bisect_left(archived['time'], limit) if limit is not None else len(archived['time'])
+            for i in range(start_index, end_index, chunk_size):
+                j = min(i + chunk_size, end_index)
+                yield {name: column[i:j] for name, column in archived.items()}
+                cursor = archived['time'][j - 1] + 1
         
-        self.save_data()
+        while True:
+            with self.lock:
+                i = bisect_left(self.times, cursor)
+                j = bisect_left(self.times, end_seconds) if end_seconds is not None else len(self.times)
+                j = min(j, i + chunk_size)
+                if i >= j:
+                    return
+                chunk = self.get_columns_at(i, j)
+            cursor = chunk['time'][-1] + 1
+            yield chunk
+    
+    def get_archived_columns(self, start_seconds, end_seconds, hot_start, hot_columns):
+        """Archived rows from start_seconds up to the hot store, followed by hot_columns"""
+        limits = [value for value in (end_seconds, hot_start) if value is not None]
+        limit = min(limits) if limits else None
+        first_month = history_month(start_seconds)
+        last_month = history_month(limit) if limit is not None else None
+        columns = {name: array(hot_columns[name].typecode) for name in hot_columns}
+        with history_archive_lock:
+            for month in history_archive_months():
+                if month < first_month or (last_month and month > last_month):
+                    continue
+                archived = read_history_archive_month(month)
+                start_index = bisect_left(archived['time'], start_seconds)
+                end_index = bisect_left(archived['time'], limit) if limit is not None else len(archived['time'])
+                for name in columns:
+                    columns[name].extend(archived[name][start_index:end_index])
+        for name in columns:
+            columns[name].extend(hot_columns[name])
+        return columns
     
     def get_records(self, days=1):
         now = datetime.now()
         start_date = (now - timedelta(days=days)).strftime("%Y-%m-%d")
-        
-        # Filter records by date
-        filtered_records = [record for record in self.data['hourly_records'] 
-                          if record['timestamp'] >= start_date]
-        
-        return filtered_records
+        return history_rows(self.get_columns(start_date))
 
 # Initialize data storage
 data_storage = DataStorage()
+atexit.register(data_storage.close)
+
+# Telemetry: raw samples for a short window, rolled up into minute, hour and day tiers
+TELEMETRY_FILE = 'telemetry_rollups.json'  # Hour and day tiers are kept across restarts
+TELEMETRY_POLL_INTERVAL = int(os.getenv('TELEMETRY_POLL_INTERVAL', 10))  # Seconds between meter polls, 0 samples only with the 5 minute fetch
+TELEMETRY_METRICS = ['phase_a_power', 'phase_b_power', 'phase_c_power', 'total_power', 'indoor_temp', 'humidity', 'roller_state']
+TELEMETRY_ENERGY_METRICS = ['phase_a_power', 'phase_b_power', 'phase_c_power', 'total_power']  # Integrated to Wh
+TELEMETRY_MAX_GAP = 15 * 60  # Longer gaps between samples are not integrated
+TELEMETRY_MAX_POINTS = 1500  # Largest number of points a tier may return before a coarser one is used
+# (name, bucket seconds, retention seconds), finest first, the raw tier has no buckets
+TELEMETRY_TIERS = [
+    ('raw', 0, 6 * 3600),
+    ('minute', 60, 2 * 86400),
+    ('hour', 3600, 90 * 86400),
+    ('day', 86400, 5 * 365 * 86400)
+]
+TELEMETRY_PERSISTED_TIERS = ('hour', 'day')
+
+def telemetry_bucket_bounds(resolution, epoch):
+    """Start and end of the bucket containing epoch, days follow local midnight"""
+    if resolution < 86400:
+        start = epoch - epoch % resolution
+        return start, start + resolution
+    sweden_tz = pytz.timezone('Europe/Stockholm')
+    day = datetime.fromtimestamp(epoch, sweden_tz).date()
+    start = sweden_tz.localize(datetime.combine(day, datetime.min.time()))
+    end = sweden_tz.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    return int(start.timestamp()), int(end.timestamp())
+
+class TelemetryStore:
+    """Raw telemetry samples for a short window plus minute, hour and day rollups
+    with min, max, mean and (for power) the energy integral in Wh.
+    Every sample updates the open bucket of each tier, so the rollups are always
+    current, and each tier is trimmed to its own retention."""
+    def __init__(self, filename=TELEMETRY_FILE):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.version = 0  # Increased with every sample
+        self.last_time = None
+        self.last_values = {}
+        self.raw = {'times': array('q'), 'columns': {metric: array('d') for metric in TELEMETRY_METRICS}}
+        self.tiers = {name: self.new_tier() for name, resolution, retention in TELEMETRY_TIERS if resolution}
+        self.load()
+    
+    def new_tier(self):
+        columns = {}
+        for metric in TELEMETRY_METRICS:
+            columns[metric] = {'count': array('I'), 'min': array('d'), 'max': array('d'), 'sum': array('d')}
+            if metric in TELEMETRY_ENERGY_METRICS:
+                columns[metric]['energy'] = array('d')
+        return {'starts': array('q'), 'ends': array('q'), 'columns': columns}
+    
+    def load(self):
+        try:
+            if not os.path.exists(self.filename):
+                return
+            with open(self.filename, 'r') as f:
+                saved = json.load(f)
+            for name in TELEMETRY_PERSISTED_TIERS:
+                if name not in saved:
+                    continue
+                tier = self.tiers[name]
+                tier['starts'].extend(saved[name]['starts'])
+                tier['ends'].extend(saved[name]['ends'])
+                for metric, columns in tier['columns'].items():
+                    for key, column in columns.items():
+                        column.extend(saved[name]['columns'][metric][key])
+            print(f"Loaded telemetry rollups from {self.filename}")
+        except Exception as e:
+            print(f"Error loading telemetry rollups: {str(e)}")
+            self.tiers = {name: self.new_tier() for name, resolution, retention in TELEMETRY_TIERS if resolution}
+    
+    def save(self):
+        """Write the persisted tiers atomically"""
+        with self.lock:
+            saved = {name: {
+                'starts': self.tiers[name]['starts'].tolist(),
+                'ends': self.tiers[name]['ends'].tolist(),
+                'columns': {metric: {key: column.tolist() for key, column in columns.items()}
+                            for metric, columns in self.tiers[name]['columns'].items()}
+            } for name in TELEMETRY_PERSISTED_TIERS}
+        try:
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as f:
+                json.dump(saved, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_filename, self.filename)
+        except Exception as e:
+            print(f"Error saving telemetry rollups: {str(e)}")
+    
+    def open_bucket(self, tier, start, end):
+        """Index of the bucket starting at start, appended if it is newer than the last one"""
+        starts = tier['starts']
+        if not starts or starts[-1] < start:
+            starts.append(start)
+            tier['ends'].append(end)
+            for columns in tier['columns'].values():
+                columns['count'].append(0)
+                columns['min'].append(float('nan'))
+                columns['max'].append(float('nan'))
+                columns['sum'].append(0.0)
+                if 'energy' in columns:
+                    columns['energy'].append(0.0)
+            return len(starts) - 1
+        index = bisect_left(starts, start)
+        if index < len(starts) and starts[index] == start:
+            return index
+        return None
+    
+    def trim_tier(self, tier, cutoff):
+        count = bisect_right(tier['ends'], cutoff)
+        if count:
+            del tier['starts'][:count]
+            del tier['ends'][:count]
+            for columns in tier['columns'].values():
+                for column in columns.values():
+                    del column[:count]
+    
+    def add_sample(self, epoch, values):
+        """Add one sample, values maps metric names to numbers or None.
+        Returns False for a sample that is not newer than the last one."""
+        epoch = int(epoch)
+        hour_closed = False
+        with self.lock:
+            if self.last_time is not None and epoch <= self.last_time:
+                return False
+            integrate = self.last_time is not None and epoch - self.last_time <= TELEMETRY_MAX_GAP
+            
+            for name, resolution, retention in TELEMETRY_TIERS:
+                if not resolution:
+                    continue
+                tier = self.tiers[name]
+                bucket_count = len(tier['starts'])
+                
+                # Power held at the previous value until this sample, split at bucket edges
+                if integrate:
+                    segment_start = self.last_time
+                    while segment_start < epoch:
+                        start, end = telemetry_bucket_bounds(resolution, segment_start)
+                        segment_end = min(end, epoch)
+                        index = self.open_bucket(tier, start, end)
+                        if index is not None:
+                            for metric in TELEMETRY_ENERGY_METRICS:
+                                power = self.last_values.get(metric)
+                                if power is not None:
+                                    tier['columns'][metric]['energy'][index] += power * (segment_end - segment_start) / 3600
+                        segment_start = segment_end
+                
+                start, end = telemetry_bucket_bounds(resolution, epoch)
+                index = self.open_bucket(tier, start, end)
+                if index is not None:
+                    for metric, value in values.items():
+                        if value is None or metric not in tier['columns']:
+                            continue
+                        columns = tier['columns'][metric]
+                        if columns['count'][index] == 0:
+                            columns['min'][index] = value
+                            columns['max'][index] = value
+                        else:
+                            columns['min'][index] = min(columns['min'][index], value)
+                            columns['max'][index] = max(columns['max'][index], value)
+                        columns['count'][index] += 1
+                        columns['sum'][index] += value
+                
+                if len(tier['starts']) > bucket_count:
+                    self.trim_tier(tier, epoch - retention)
+                    if name == 'hour' and bucket_count:
+                        hour_closed = True
+            
+            self.raw['times'].append(epoch)
+            for metric, column in self.raw['columns'].items():
+                value = values.get(metric)
+                column.append(float('nan') if value is None else value)
+            count = bisect_left(self.raw['times'], epoch - TELEMETRY_TIERS[0][2])
+            if count:
+                del self.raw['times'][:count]
+                for column in self.raw['columns'].values():
+                    del column[:count]
+            
+            self.last_time = epoch
+            self.version += 1
+            self.last_values = values
+        
+        if hour_closed:
+            self.save()
+        return True
+    
+    def select_tier(self, start, end):
+        """Finest tier that still holds start and returns at most TELEMETRY_MAX_POINTS points"""
+        now = time.time()
+        for name, resolution, retention in TELEMETRY_TIERS:
+            if start < now - retention:
+                continue
+            step = resolution or TELEMETRY_POLL_INTERVAL or 300
+            if (end - start) / step <= TELEMETRY_MAX_POINTS:
+                return name
+        return TELEMETRY_TIERS[-1][0]
+    
+    def get_columns(self, tier_name, start, end, metrics=TELEMETRY_METRICS):
+        """Columns between the epochs start and end, raw samples or bucket aggregates.
+        Times are epoch seconds. Raw metrics are one list of values each, bucket
+        metrics a dict of min, max and mean lists (plus energy_wh for power)."""
+        def number(value, digits):
+            return None if value != value else round(value, digits)  # NaN marks a missing value
+        
+        with self.lock:
+            if tier_name == 'raw':
+                times = self.raw['times']
+                first, last = bisect_left(times, start), bisect_right(times, end)
+                result = {'time': times[first:last].tolist()}
+                for metric in metrics:
+                    result[metric] = [number(value, 3) for value in self.raw['columns'][metric][first:last]]
+                return result
+            
+            tier = self.tiers[tier_name]
+            first, last = bisect_right(tier['ends'], start), bisect_right(tier['starts'], end)
+            result = {'time': tier['starts'][first:last].tolist(), 'time_end': tier['ends'][first:last].tolist()}
+            for metric in metrics:
+                columns = tier['columns'][metric]
+                counts = columns['count'][first:last]
+                values = result[metric] = {
+                    'min': [number(value, 3) if count else None for value, count in zip(columns['min'][first:last], counts)],
+                    'max': [number(value, 3) if count else None for value, count in zip(columns['max'][first:last], counts)],
+                    'mean': [number(total / count, 3) if count else None
+                             for total, count in zip(columns['sum'][first:last], counts)]
+                }
+                if 'energy' in columns:
+                    values['energy_wh'] = [round(value, 3) for value in columns['energy'][first:last]]
+        return result
+
+telemetry_store = TelemetryStore()
+atexit.register(telemetry_store.save)
+
+def record_telemetry_sample():
+    """Add the latest device readings to the telemetry store"""
+    try:
+        meter = devices['energy-meter']
+        indoor_temp = devices['indoor-sensor'].get('temperature')
+        if indoor_temp is None:
+            indoor_temp = devices['shelly-roller'].get('indoor_temp')
+        telemetry_store.add_sample(time.time(), {
+            'phase_a_power': meter.get('phase_a_power'),
+            'phase_b_power': meter.get('phase_b_power'),
+            'phase_c_power': meter.get('phase_c_power'),
+            'total_power': meter.get('total_power'),
+            'indoor_temp': indoor_temp,
+            'humidity': devices['indoor-sensor'].get('humidity'),
+            'roller_state': 1.0 if devices['shelly-roller'].get('state') == 'on' else 0.0
+        })
+    except Exception as e:
+        print(f"Error recording telemetry: {str(e)}")
 
 # Function to fetch indoor sensor data
 def fetch_indoor_sensor_data():
@@ -397,9 +1606,13 @@ def schedule_sensor_data_fetch():
     
     # Record data for history
     record_current_data()
+    if TELEMETRY_POLL_INTERVAL <= 0:
+        record_telemetry_sample()
     
-    # Schedule the next fetch in 5 minutes
-    threading.Timer(300, schedule_sensor_data_fetch).start()
+    # Schedule the next fetch in 5 minutes, without keeping the process alive on exit
+    timer = threading.Timer(300, schedule_sensor_data_fetch)
+    timer.daemon = True
+    timer.start()
     
 # Function to record current data for history
 def record_current_data():
@@ -413,8 +1626,14 @@ def record_current_data():
             indoor_temp = devices['shelly-roller']['indoor_temp']
             
         outdoor_temp = app.config.get('OUTDOOR_TEMP')
+        if outdoor_temp is None:
+            outdoor_temp = get_aligned_outdoor_temp()
         roller_position = 'open' if devices['shelly-roller']['state'] == 'on' else 'closed'
-        electricity_price = app.config.get('CURRENT_PRICE', 0)
+        electricity_price = get_current_price()
+        if electricity_price is None:
+            electricity_price = app.config.get('CURRENT_PRICE', 0)
+        else:
+            app.config['CURRENT_PRICE'] = electricity_price
         
         # Get solar production from energy meter if available
         solar_production = 0
@@ -493,119 +1712,972 @@ devices = {
     }
 }
 
-def get_electricity_prices():
+def poll_telemetry():
+    """Read the phase powers from the 3EM meter and record a telemetry sample"""
+    try:
+        response = requests.get(f"http://{devices['energy-meter']['ip']}/rpc/EM.GetStatus?id=0", timeout=5)
+        if response.status_code == 200:
+            em_data = response.json()
+            meter = devices['energy-meter']
+            for phase in ('a', 'b', 'c'):
+                if f'{phase}_act_power' in em_data:
+                    meter[f'phase_{phase}_power'] = round(em_data[f'{phase}_act_power'], 1)
+            if 'total_act_power' in em_data:
+                meter['total_power'] = em_data['total_act_power']
+    except Exception as e:
+        print(f"Error polling energy meter: {str(e)}")
+    record_telemetry_sample()
+    
+    timer = threading.Timer(TELEMETRY_POLL_INTERVAL, poll_telemetry)
+    timer.daemon = True
+    timer.start()
+
+if TELEMETRY_POLL_INTERVAL > 0:
+    telemetry_timer = threading.Timer(0, poll_telemetry)
+    telemetry_timer.daemon = True
+    telemetry_timer.start()
+
+# Electricity price API configuration
+PRICE_API_BASE_URL = "https://www.elprisetjustnu.se/api/v1/prices/"
+PRICE_AREAS_VALID = ('SE1', 'SE2', 'SE3', 'SE4')
+# Bidding areas loaded by the price scheduler, the first one is the home area
+PRICE_AREAS = [area.strip().upper() for area in os.getenv('PRICE_AREAS', 'SE3').split(',')
+               if area.strip().upper() in PRICE_AREAS_VALID] or ['SE3']
+PRICE_AREA = PRICE_AREAS[0]
+PRICE_CACHE_FILE = 'price_cache.json'
+PRICE_MISSING_TTL = 15 * 60  # Seconds before an unpublished day is tried again
+PRICE_CACHE_KEEP_DAYS = 7  # Days of old prices kept in the cache file
+PRICE_ARCHIVE_DIR = 'price_archive'  # Long-term price archive, one file per area and month
+PRICE_PUBLISH_HOUR = 13  # Tomorrow's day-ahead prices are published shortly after 13:00
+PRICE_RETRY_MIN_DELAY = 60  # First retry delay in seconds while waiting for tomorrow's prices
+PRICE_RETRY_MAX_DELAY = 30 * 60  # Upper limit for the exponential backoff
+PRICE_CHEAPEST_DEFAULTS = {'n': 3, 'window': 3, 'horizon': 24}  # Precomputed cheapest-hours query
+
+# URL patterns accepted by the price API, the one that last worked is tried first
+PRICE_URL_PATTERNS = [
+    "{year}/{month:02d}-{day:02d}_{area}.json",
+    "{year}-{month:02d}-{day:02d}_{area}.json",
+    "{year}/{month}-{day}_{area}.json",
+    "{year}-{month}-{day}_{area}.json"
+]
+
+# Cache for electricity prices, keyed by (area, date).
+# A published day never changes, so it is never fetched again.
+price_cache = {
+    'days': {},     # (area, date) -> price day, see make_price_day
+    'missing': {},  # (area, date) -> datetime when the day was last found missing
+    'url_pattern': 0,  # Index in PRICE_URL_PATTERNS of the last pattern that worked
+    'inflight': {}  # (area, date) -> threading.Event for fetches in progress
+}
+price_cache_lock = threading.Lock()
+
+# Worker threads used to fetch several price days at the same time
+price_fetch_executor = ThreadPoolExecutor(max_workers=2 * len(PRICE_AREAS_VALID),
+                                          thread_name_prefix='price-fetch')
+
+def load_price_cache():
+    """Load previously fetched price days from the cache file"""
+    try:
+        if not os.path.exists(PRICE_CACHE_FILE):
+            return
+        with open(PRICE_CACHE_FILE, 'r') as f:
+            stored = json.load(f)
+        with price_cache_lock:
+            for key, day in stored.get('days', {}).items():
+                area, date_str = key.split('/')
+                if isinstance(day, list):
+                    # Older cache files stored a list of price entries
+                    day = make_price_day(day, date_str)
+                else:
+                    day['prices'] = array('d', day['prices'])
+                price_cache['days'][(area, date_str)] = day
+            if stored.get('url_pattern', 0) < len(PRICE_URL_PATTERNS):
+                price_cache['url_pattern'] = stored.get('url_pattern', 0)
+        print(f"Loaded {len(price_cache['days'])} cached price days from {PRICE_CACHE_FILE}")
+        # Days cached before the archive existed
+        for (area, date_str), day in list(price_cache['days'].items()):
+            archive_price_day(area, day)
+    except Exception as e:
+        print(f"Error loading price cache: {str(e)}")
+
+def save_price_cache():
+    """Write the price cache to disk, dropping days older than PRICE_CACHE_KEEP_DAYS"""
+    try:
+        oldest = (datetime.now(pytz.timezone('Europe/Stockholm')) - timedelta(days=PRICE_CACHE_KEEP_DAYS)).date().isoformat()
+        with price_cache_lock:
+            for key in [key for key in price_cache['days'] if key[1] < oldest]:
+                del price_cache['days'][key]
+            stored = {
+                'days': {f"{area}/{date_str}": dict(day, prices=day['prices'].tolist())
+                         for (area, date_str), day in price_cache['days'].items()},
+                'url_pattern': price_cache['url_pattern']
+            }
+        temp_filename = PRICE_CACHE_FILE + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(stored, f)
+        os.replace(temp_filename, PRICE_CACHE_FILE)
+        return True
+    except Exception as e:
+        print(f"Error saving price cache: {str(e)}")
+        return False
+
+def fetch_day_prices(area, target_date):
+    """Fetch the prices for one day from elprisetjustnu.se, None if not available.
+    The URL pattern that worked last time is tried first, the others only if it fails."""
+    preferred = price_cache['url_pattern']
+    pattern_order = [preferred] + [i for i in range(len(PRICE_URL_PATTERNS)) if i != preferred]
+    for pattern_index in pattern_order:
+        date_str = PRICE_URL_PATTERNS[pattern_index].format(
+            year=target_date.year, month=target_date.month, day=target_date.day, area=area)
+        url = PRICE_API_BASE_URL + date_str
+        print(f"Trying URL: {url}")
+        try:
+            response = requests.get(url, timeout=10) # Added timeout
+            print(f"Response status: {response.status_code}")
+            if response.status_code == 200:
+                day_prices = response.json()
+                print(f"Successfully retrieved {len(day_prices)} price entries for {target_date}")
+                if not day_prices:
+                    return None
+                if pattern_index != preferred:
+                    print(f"Remembering URL pattern {PRICE_URL_PATTERNS[pattern_index]}")
+                    price_cache['url_pattern'] = pattern_index
+                return make_price_day(day_prices, target_date.isoformat())
+            elif response.status_code == 404:
+                print(f"404 Not Found for URL: {url}")
+                continue
+            response.raise_for_status()
+        except Exception as e:
+            print(f"Error with {url}: {str(e)}")
+    return None
+
+def parse_price_time(value):
+    """Parse an ISO timestamp from the price API into epoch seconds"""
+    return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+
+def make_price_day(price_items, date_str):
+    """Convert the price entries of one day into a compact price day:
+    {'date', 'start' (epoch of the first slot), 'resolution' (seconds per slot),
+    'prices' (array of SEK/kWh, one per slot)}. The slot times are implied by the
+    index, so a day at 15-minute resolution costs 96 floats. If a day mixes hourly
+    and quarter-hourly entries the finest resolution is used."""
+    starts = [parse_price_time(item['time_start']) for item in price_items]
+    ends = []
+    for i, item in enumerate(price_items):
+        if item.get('time_end'):
+            ends.append(parse_price_time(item['time_end']))
+        elif i + 1 < len(starts):
+            ends.append(starts[i + 1])
+        else:
+            ends.append(None)
+    durations = [end - start for start, end in zip(starts, ends) if end and end > start]
+    resolution = 900 if durations and min(durations) < 3600 else 3600
+    if ends and ends[-1] is None:
+        ends[-1] = starts[-1] + resolution
+
+    day_start = min(starts) if starts else 0
+    prices = array('d')
+    for start, end, item in sorted(zip(starts, ends, price_items), key=lambda x: x[0]):
+        # Repeat the previous price over any gap, then fill this entry's slots
+        first_slot = (start - day_start) // resolution
+        while len(prices) < first_slot:
+            prices.append(prices[-1] if prices else item['SEK_per_kWh'])
+        del prices[first_slot:]
+        prices.extend([item['SEK_per_kWh']] * max((end - start) // resolution, 1))
+    return {'date': date_str, 'start': day_start, 'resolution': resolution, 'prices': prices}
+
+def price_slot_entry(slot_start, resolution, price):
+    """Price entry dict for one slot, used at the JSON/template boundary"""
     sweden_tz = pytz.timezone('Europe/Stockholm')
-    now = datetime.now(sweden_tz)
-    prices = []
-    for days_ahead in [0, 1]:
-        target_date = now + timedelta(days=days_ahead)
-        year = target_date.year
-        month = target_date.month
-        day = target_date.day
-        date_formats = [
-            f"{year}/{month:02d}-{day:02d}_SE3.json",
-            f"{year}-{month:02d}-{day:02d}_SE3.json",
-            f"{year}/{month}-{day}_SE3.json",
-            f"{year}-{month}-{day}_SE3.json"
-        ]
-        base_url = "https://www.elprisetjustnu.se/api/v1/prices/"
-        for date_str in date_formats:
-            url = base_url + date_str
-            print(f"Trying URL: {url}")
-            try:
-                response = requests.get(url, timeout=10) # Added timeout
-                print(f"Response status: {response.status_code}")
-                if response.status_code == 200:
-                    day_prices = response.json()
-                    print(f"Successfully retrieved {len(day_prices)} price entries for {target_date.date()}")
-                    for price_item in day_prices:
-                        prices.append({
-                            'time_start': price_item['time_start'],
-                            'SEK_per_kWh': price_item['SEK_per_kWh'],
-                            'date': target_date.date().isoformat()
-                        })
+    time_start = datetime.fromtimestamp(slot_start, sweden_tz)
+    return {
+        'time_start': time_start.isoformat(),
+        'time_end': datetime.fromtimestamp(slot_start + resolution, sweden_tz).isoformat(),
+        'SEK_per_kWh': price,
+        'date': time_start.date().isoformat()
+    }
+
+def price_day_entries(day):
+    """Expand a price day into a list of price entry dicts"""
+    return [price_slot_entry(day['start'] + slot * day['resolution'], day['resolution'], price)
+            for slot, price in enumerate(day['prices'])]
+
+def get_cached_day_prices(area, target_date):
+    """Get the prices for one day from the cache only, None if not cached"""
+    with price_cache_lock:
+        return price_cache['days'].get((area, target_date.isoformat()))
+
+def get_day_prices(area, target_date, force=False):
+    """Get the prices for one day, from the cache when possible.
+    With force=True a day recently found missing is tried again right away.
+    Concurrent callers for the same day wait for a single fetch."""
+    key = (area, target_date.isoformat())
+    while True:
+        with price_cache_lock:
+            if key in price_cache['days']:
+                return price_cache['days'][key]
+            missing_since = price_cache['missing'].get(key)
+            if (not force and missing_since and
+                (datetime.now() - missing_since).total_seconds() < PRICE_MISSING_TTL):
+                return None
+            inflight = price_cache['inflight'].get(key)
+            if inflight is None:
+                inflight = price_cache['inflight'][key] = threading.Event()
+                break
+        # Another thread is fetching this day, use its result
+        inflight.wait()
+        force = False
+
+    try:
+        day_prices = fetch_day_prices(area, target_date)
+        with price_cache_lock:
+            if day_prices:
+                price_cache['days'][key] = day_prices
+                price_cache['missing'].pop(key, None)
+            else:
+                price_cache['missing'][key] = datetime.now()
+    finally:
+        with price_cache_lock:
+            price_cache['inflight'].pop(key, None)
+        inflight.set()
+    if day_prices:
+        save_price_cache()
+        archive_price_day(area, day_prices)
+    return day_prices
+
+# Long-term price archive. Each area has one append-only file per month
+# (price_archive/SE3/2025-05.bin) holding one block per day:
+# a little-endian header (day start epoch, resolution, slot count) followed
+# by the day's prices as float64. Slot times are implied, as in the price days.
+PRICE_ARCHIVE_HEADER = struct.Struct('<qII')
+
+# Parsed month files, (area, month) -> {'starts': [...], 'blocks': [price day, ...]}
+price_archive = {}
+price_archive_lock = threading.Lock()
+
+def price_archive_path(area, month):
+    return os.path.join(PRICE_ARCHIVE_DIR, area, f"{month}.bin")
+
+def read_price_archive_month(area, month):
+    """Return the parsed blocks of one month file, sorted by day start.
+    Must be called with price_archive_lock held."""
+    cached = price_archive.get((area, month))
+    if cached is not None:
+        return cached
+
+    blocks = []
+    path = price_archive_path(area, month)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + PRICE_ARCHIVE_HEADER.size <= len(data):
+            day_start, resolution, count = PRICE_ARCHIVE_HEADER.unpack_from(data, offset)
+            offset += PRICE_ARCHIVE_HEADER.size
+            if offset + count * 8 > len(data):
+                print(f"Price archive: Ignoring incomplete block at the end of {path}")
+                break
+            prices = array('d')
+            prices.frombytes(data[offset:offset + count * 8])
+            if sys.byteorder == 'big':
+                prices.byteswap()
+            offset += count * 8
+            blocks.append({'start': day_start, 'resolution': resolution, 'prices': prices})
+    blocks.sort(key=lambda block: block['start'])
+    cached = price_archive[(area, month)] = {
+        'starts': [block['start'] for block in blocks],
+        'blocks': blocks
+    }
+    return cached
+
+def archive_price_day(area, day):
+    """Append a price day to the archive unless it is already there"""
+    month = day['date'][:7]
+    try:
+        with price_archive_lock:
+            archived = read_price_archive_month(area, month)
+            if day['start'] in archived['starts']:
+                return False
+            prices = array('d', day['prices'])
+            if sys.byteorder == 'big':
+                prices.byteswap()
+            path = price_archive_path(area, month)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as f:
+                f.write(PRICE_ARCHIVE_HEADER.pack(day['start'], day['resolution'], len(prices)) +
+                        prices.tobytes())
+            # Re-read the month on next access
+            price_archive.pop((area, month), None)
+        return True
+    except Exception as e:
+        print(f"Error archiving prices for {area} {day['date']}: {str(e)}")
+        return False
+
+def read_price_archive(area, start_date, end_date):
+    """Read archived prices from start_date to end_date (inclusive) as two columns:
+    (slot start epochs as array('q'), prices as array('d'))"""
+    sweden_tz = pytz.timezone('Europe/Stockholm')
+    range_start = int(sweden_tz.localize(datetime.combine(start_date, datetime.min.time())).timestamp())
+    range_end = int(sweden_tz.localize(datetime.combine(end_date + timedelta(days=1), datetime.min.time())).timestamp())
+
+    months = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        months.append(f"{year}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    times = array('q')
+    prices = array('d')
+    with price_archive_lock:
+        for month in months:
+            archived = read_price_archive_month(area, month)
+            # Blocks are whole days, the range starts at local midnight
+            first = bisect_left(archived['starts'], range_start)
+            for block in archived['blocks'][first:]:
+                if block['start'] >= range_end:
                     break
-                elif response.status_code == 404:
-                    print(f"404 Not Found for URL: {url}")
-                    continue
-                response.raise_for_status()
-            except Exception as e:
-                print(f"Error with {url}: {str(e)}")
-    if not prices:
-        print("Failed to fetch prices after multiple attempts, returning empty list.")
-        return []
-    prices.sort(key=lambda x: x['time_start'])
-    return prices
+                resolution = block['resolution']
+                times.extend(range(block['start'], block['start'] + len(block['prices']) * resolution, resolution))
+                prices.extend(block['prices'])
+    return times, prices
+
+def new_price_state():
+    """Empty in-memory price state for one bidding area"""
+    return {
+        'date': None,  # Local date of "today" for the prices below
+        'days': [],  # Price days for today and tomorrow, see make_price_day
+        'has_tomorrow': False,
+        'series': {'start': 0, 'resolution': 3600, 'prices': array('d')},  # See merge_price_days
+        'entries': None,  # Price entry dicts for the API, built on first use
+        'cheapest': {}  # Cached cheapest-hours results, cleared on every refresh
+    }
+
+# Prices for today and tomorrow per bidding area, kept up to date by the
+# price scheduler. Request handlers only read from here.
+price_states = {area: new_price_state() for area in PRICE_AREAS}
+
+# Status of the background price scheduler
+price_scheduler = {
+    'last_run': None,
+    'last_success': None,
+    'next_run': None,
+    'last_error': None,
+    'retry_delay': PRICE_RETRY_MIN_DELAY
+}
+
+def merge_price_days(days):
+    """Join consecutive price days into one series at the finest resolution among them,
+    so lookups and window searches are plain index arithmetic"""
+    if not days:
+        return {'start': 0, 'resolution': 3600, 'prices': array('d')}
+    resolution = min(day['resolution'] for day in days)
+    prices = array('d')
+    for day in days:
+        repeat = day['resolution'] // resolution
+        if repeat == 1:
+            prices.extend(day['prices'])
+        else:
+            for price in day['prices']:
+                prices.extend([price] * repeat)
+    return {'start': days[0]['start'], 'resolution': resolution, 'prices': prices}
+
+def refresh_price_states(areas, fetch_tomorrow=True, force=False):
+    """Rebuild the price state of each area for the current local day from the price cache.
+    All (area, day) pairs are fetched at the same time. Tomorrow is only fetched from the
+    API when fetch_tomorrow is set. Returns {area: (has_today, has_tomorrow)}."""
+    sweden_tz = pytz.timezone('Europe/Stockholm')
+    today = datetime.now(sweden_tz).date()
+    tomorrow = today + timedelta(days=1)
+
+    futures = {}
+    for area in areas:
+        futures[(area, today)] = price_fetch_executor.submit(get_day_prices, area, today, force)
+        if fetch_tomorrow:
+            futures[(area, tomorrow)] = price_fetch_executor.submit(get_day_prices, area, tomorrow, force)
+
+    results = {}
+    for area in areas:
+        today_prices = futures[(area, today)].result()
+        if fetch_tomorrow:
+            tomorrow_prices = futures[(area, tomorrow)].result()
+        else:
+            tomorrow_prices = get_cached_day_prices(area, tomorrow)
+
+        days = [day for day in (today_prices, tomorrow_prices) if day]
+        state = new_price_state()
+        state.update({
+            'date': today,
+            'days': days,
+            'has_tomorrow': bool(tomorrow_prices),
+            'series': merge_price_days(days)
+        })
+        price_states[area] = state
+        get_cheapest_prices(area=area, **PRICE_CHEAPEST_DEFAULTS)
+        results[area] = (bool(today_prices), bool(tomorrow_prices))
+    return results
+
+def ensure_price_state(area=PRICE_AREA):
+    """Return the price state for an area, rebuilding it from the cache if the
+    scheduler has not rotated to the new day yet. Areas outside PRICE_AREAS, which
+    the scheduler does not refresh, are also rebuilt once tomorrow's prices may have
+    been published; configured areas are only ever read from memory here."""
+    sweden_tz = pytz.timezone('Europe/Stockholm')
+    now = datetime.now(sweden_tz)
+    state = price_states.get(area)
+    stale = state is None or state['date'] != now.date()
+    if (not stale and area not in PRICE_AREAS and not state['has_tomorrow']
+            and now.hour >= PRICE_PUBLISH_HOUR):
+        # Look for tomorrow again, unless it was found missing within PRICE_MISSING_TTL
+        key = (area, (now.date() + timedelta(days=1)).isoformat())
+        with price_cache_lock:
+            missing_since = price_cache['missing'].get(key)
+        stale = not missing_since or (datetime.now() - missing_since).total_seconds() >= PRICE_MISSING_TTL
+    if stale:
+        refresh_price_states([area], fetch_tomorrow=now.hour >= PRICE_PUBLISH_HOUR)
+    return price_states[area]
+
+def get_electricity_prices(area=PRICE_AREA):
+    """Return today's and tomorrow's prices for a bidding area from memory"""
+    state = ensure_price_state(area)
+    if state['entries'] is None:
+        state['entries'] = [entry for day in state['days'] for entry in price_day_entries(day)]
+    if not state['entries']:
+        print(f"No electricity prices available for {area}, returning empty list.")
+    return state['entries']
+
+def get_current_price(area=PRICE_AREA):
+    """Return the price for the current slot (hour or quarter-hour), None if unknown"""
+    series = ensure_price_state(area)['series']
+    slot = (int(time.time()) - series['start']) // series['resolution']
+    if 0 <= slot < len(series['prices']):
+        return series['prices'][slot]
+    return None
+
+def find_cheapest_prices(prices, n, window):
+    """Find the n cheapest slots and the start of the cheapest run of `window`
+    consecutive slots, using a sliding sum so the window search is O(len(prices)).
+    Returns (cheapest slot indexes in time order, window start, window sum)."""
+    cheapest = sorted(heapq.nsmallest(n, range(len(prices)), key=prices.__getitem__))
+    if window <= 0 or len(prices) < window:
+        return cheapest, None, None
+
+    window_sum = sum(prices[:window])
+    best_sum = window_sum
+    best_start = 0
+    for i in range(window, len(prices)):
+        window_sum += prices[i] - prices[i - window]
+        if window_sum < best_sum:
+            best_sum = window_sum
+            best_start = i - window + 1
+    return cheapest, best_start, best_sum
+
+def get_cheapest_prices(n, window, horizon, area=PRICE_AREA):
+    """Return the n cheapest whole hours starting from the next hour, and the cheapest
+    window of `window` hours within `horizon` hours from now. Hours are priced at the
+    average of their slots, the window is searched at the native price resolution.
+    Results are cached until the next price refresh."""
+    series = ensure_price_state(area)['series']
+    resolution = series['resolution']
+    slots_per_hour = 3600 // resolution
+    start_slot = max((int(time.time()) - series['start']) // resolution, 0)
+    end_slot = min(start_slot + horizon * slots_per_hour, len(series['prices']))
+
+    state = price_states[area]
+    key = (start_slot, end_slot, n, window)
+    cached = state['cheapest'].get(key)
+    if cached is not None:
+        return cached
+
+    prices = series['prices'][start_slot:end_slot]
+    window_slots = window * slots_per_hour
+    _, best_start, best_sum = find_cheapest_prices(prices, 0, window_slots)
+
+    # Whole hours after the current one, the series starts at local midnight
+    first_hour_slot = (start_slot // slots_per_hour + 1) * slots_per_hour
+    hour_starts = range(first_hour_slot, end_slot - slots_per_hour + 1, slots_per_hour)
+    hour_prices = [round(sum(series['prices'][slot:slot + slots_per_hour]) / slots_per_hour, 5)
+                   for slot in hour_starts]
+    cheapest_hours, _, _ = find_cheapest_prices(hour_prices, n, 0)
+
+    def slot_entry(slot):
+        slot_start = series['start'] + (start_slot + slot) * resolution
+        return price_slot_entry(slot_start, resolution, prices[slot])
+
+    cached = {
+        'resolution_minutes': resolution // 60,
+        'cheapest': [price_slot_entry(series['start'] + hour_starts[hour] * resolution, 3600, hour_prices[hour])
+                     for hour in cheapest_hours],
+        'window': None
+    }
+    if best_start is not None:
+        window_entries = [slot_entry(slot) for slot in range(best_start, best_start + window_slots)]
+        cached['window'] = {
+            'start': window_entries[0]['time_start'],
+            'end': window_entries[-1]['time_end'],
+            'average_price': round(best_sum / window_slots, 5),
+            'prices': window_entries
+        }
+    if len(state['cheapest']) > 256:
+        state['cheapest'].clear()
+    state['cheapest'][key] = cached
+    return cached
+
+def schedule_price_fetch():
+    """Keep price_states current for all configured areas: fetch tomorrow's prices once
+    they are published, retrying with exponential backoff, and rotate the days at local midnight."""
+    sweden_tz = pytz.timezone('Europe/Stockholm')
+    now = datetime.now(sweden_tz)
+    publish_time = now.replace(hour=PRICE_PUBLISH_HOUR, minute=0, second=0, microsecond=0)
+    tomorrow_due = now >= publish_time
+    price_scheduler['last_run'] = now
+
+    try:
+        results = refresh_price_states(PRICE_AREAS, fetch_tomorrow=tomorrow_due, force=True)
+        complete = all(has_today and (has_tomorrow or not tomorrow_due)
+                       for has_today, has_tomorrow in results.values())
+    except Exception as e:
+        print(f"Price scheduler: Error refreshing prices: {str(e)}")
+        price_scheduler['last_error'] = str(e)
+        complete = False
+
+    if not complete:
+        # Prices are missing, retry with exponential backoff
+        delay = price_scheduler['retry_delay']
+        price_scheduler['retry_delay'] = min(delay * 2, PRICE_RETRY_MAX_DELAY)
+        if not price_scheduler['last_error']:
+            price_scheduler['last_error'] = 'Prices not available yet'
+        print(f"Price scheduler: Prices not available yet, retrying in {delay} seconds")
+    else:
+        price_scheduler['last_success'] = now
+        price_scheduler['last_error'] = None
+        price_scheduler['retry_delay'] = PRICE_RETRY_MIN_DELAY
+        if not tomorrow_due:
+            next_run = publish_time
+        else:
+            # Rotate today/tomorrow just after local midnight
+            midnight = sweden_tz.localize(datetime.combine(now.date() + timedelta(days=1), datetime.min.time()))
+            next_run = midnight + timedelta(seconds=5)
+        delay = max((next_run - now).total_seconds(), 1)
+
+    price_scheduler['next_run'] = now + timedelta(seconds=delay)
+    timer = threading.Timer(delay, schedule_price_fetch)
+    timer.daemon = True
+    timer.start()
+
+load_price_cache()
+
+# Start the price scheduler in the background so startup is not delayed
+price_scheduler_timer = threading.Timer(0, schedule_price_fetch)
+price_scheduler_timer.daemon = True
+price_scheduler_timer.start()
 
 @app.route('/')
 def index():
     current_prices = get_electricity_prices()
     return render_template('index.html', prices=current_prices, devices=devices)
 
-def get_weather_forecast(): # Modified: always Vänersborg, no args
-    """Fetch weather forecast from SMHI API for Vänersborg"""
+SMHI_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+def parse_smhi_forecast(forecast):
+    """Parse an SMHI pmp3g forecast once into a timeline of sorted epoch times
+    with one array of values per parameter (t, tcc_mean, ws, ...). Missing values are NaN."""
+    points = sorted(((calendar.timegm(time.strptime(point['validTime'], SMHI_TIME_FORMAT)), point)
+                     for point in forecast.get('timeSeries', [])), key=lambda x: x[0])
+    times = array('q', (epoch for epoch, point in points))
+    params = {}
+    units = {}
+    for i, (epoch, point) in enumerate(points):
+        for param in point['parameters']:
+            name = param['name']
+            if name not in params:
+                params[name] = array('d', [float('nan')] * len(points))
+                units[name] = param.get('unit')
+            if param.get('values'):
+                params[name][i] = param['values'][0]
+    return {
+        'approved_time': forecast.get('approvedTime'),
+        'reference_time': forecast.get('referenceTime'),
+        'times': times,
+        'params': params,
+        'units': units
+    }
+
+def format_smhi_time(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime(SMHI_TIME_FORMAT)
+
+def weather_value(value):
+    """JSON-safe forecast value, None for missing (NaN) values"""
+    return None if value != value else value
+
+def weather_nearest_index(timeline, epoch):
+    """Index of the forecast point closest to epoch, None if the timeline is empty"""
+    times = timeline['times']
+    if not times:
+        return None
+    i = bisect_left(times, epoch)
+    if i == 0:
+        return 0
+    if i == len(times):
+        return len(times) - 1
+    return i if times[i] - epoch < epoch - times[i - 1] else i - 1
+
+def weather_interpolate(timeline, name, epoch):
+    """Linearly interpolated value of a parameter at epoch, clamped to the ends of the
+    forecast. None if the parameter is missing."""
+    times = timeline['times']
+    values = timeline['params'].get(name)
+    if not times or values is None:
+        return None
+    i = bisect_right(times, epoch)
+    if i == 0:
+        return weather_value(values[0])
+    if i == len(times):
+        return weather_value(values[-1])
+    t0, t1 = times[i - 1], times[i]
+    v0, v1 = values[i - 1], values[i]
+    return weather_value(v0 + (v1 - v0) * (epoch - t0) / (t1 - t0))
+
+def resample_weather(timeline, name, start, resolution, count):
+    """Linearly interpolate a parameter onto `count` slots starting at `start`,
+    `resolution` seconds apart, in one merge pass over the sorted forecast times.
+    Slots outside the forecast are NaN."""
+    times = timeline['times']
+    values = timeline['params'].get(name)
+    resampled = array('d', [float('nan')] * count)
+    if not times or values is None:
+        return resampled
+    j = 0
+    for i in range(count):
+        slot_time = start + i * resolution
+        while j < len(times) and times[j] <= slot_time:
+            j += 1
+        if j == 0:
+            continue
+        if times[j - 1] == slot_time:
+            resampled[i] = values[j - 1]
+        elif j < len(times):
+            t0, t1 = times[j - 1], times[j]
+            resampled[i] = values[j - 1] + (values[j] - values[j - 1]) * (slot_time - t0) / (t1 - t0)
+    return resampled
+
+def get_aligned_weather(name='t', area=PRICE_AREA):
+    """Forecast parameter resampled onto the price slots of an area.
+    Returns (series start, resolution, values), cached until the forecast or prices change."""
+    forecast = get_weather_forecast()
+    series = ensure_price_state(area)['series']
+    if not forecast or name not in forecast['params']:
+        return series['start'], series['resolution'], array('d', [float('nan')] * len(series['prices']))
+
+    key = (name, area, series['start'], series['resolution'], len(series['prices']))
+    aligned = weather_cache['aligned']
+    values = aligned.get(key)
+    if values is None:
+        values = resample_weather(forecast, name, series['start'], series['resolution'], len(series['prices']))
+        if len(aligned) > 64:
+            aligned.clear()
+        aligned[key] = values
+    return series['start'], series['resolution'], values
+
+def get_aligned_outdoor_temp(area=PRICE_AREA):
+    """Forecast outdoor temperature for the current price slot, None if unknown"""
+    start, resolution, values = get_aligned_weather('t', area)
+    slot = (int(time.time()) - start) // resolution
+    if 0 <= slot < len(values):
+        return weather_value(values[slot])
+    return None
+
+def weather_projection(timeline, names, start_index, end_index):
+    """Compact column view of part of the forecast: one array per requested parameter"""
+    projection = {
+        'approvedTime': timeline['approved_time'],
+        'referenceTime': timeline['reference_time'],
+        'units': {name: timeline['units'].get(name) for name in names},
+        'time': timeline['times'][start_index:end_index].tolist()
+    }
+    for name in names:
+        projection[name] = [weather_value(value) for value in timeline['params'][name][start_index:end_index]]
+    return projection
+
+def get_weather_response(key, build):
+    """Return (json bytes, gzipped json bytes) for a /api/weather response, serializing
+    and compressing it only once per forecast"""
+    key = (weather_cache['timestamp'],) + key
+    responses = weather_cache['responses']
+    cached = responses.get(key)
+    if cached is None:
+        body = json.dumps(build(), separators=(',', ':')).encode('utf-8')
+        cached = (body, gzip.compress(body, compresslevel=6))
+        if len(responses) > 64:
+            responses.clear()
+        responses[key] = cached
+    return cached
+
+def weather_timeline_to_smhi(timeline):
+    """Rebuild an SMHI-style forecast document from a timeline"""
+    return {
+        'approvedTime': timeline['approved_time'],
+        'referenceTime': timeline['reference_time'],
+        'timeSeries': [{
+            'validTime': format_smhi_time(epoch),
+            'parameters': [{
+                'name': name,
+                'unit': timeline['units'].get(name),
+                'values': [weather_value(values[i])]
+            } for name, values in timeline['params'].items()]
+        } for i, epoch in enumerate(timeline['times'])]
+    }
+
+def load_weather_cache():
+    """Load the last saved forecast from disk"""
+    try:
+        if not os.path.exists(WEATHER_CACHE_FILE):
+            return
+        with open(WEATHER_CACHE_FILE, 'r') as f:
+            stored = json.load(f)
+        data = stored['data']
+        if 'timeSeries' in data:
+            # Older cache files stored the raw SMHI document
+            timeline = parse_smhi_forecast(data)
+        else:
+            timeline = dict(data, times=array('q', data['times']),
+                            params={name: array('d', values) for name, values in data['params'].items()})
+        with weather_cache_lock:
+            weather_cache.update({
+                'timestamp': datetime.fromisoformat(stored['timestamp']),
+                'data': timeline,
+                'location': stored['location'],
+                'aligned': {},
+                'responses': {}
+            })
+        print(f"Loaded weather forecast from {WEATHER_CACHE_FILE} ({stored['timestamp']})")
+    except Exception as e:
+        print(f"Error loading weather cache: {str(e)}")
+
+def save_weather_cache():
+    """Save the current forecast to disk"""
+    try:
+        with weather_cache_lock:
+            timeline = weather_cache['data']
+            stored = {
+                'timestamp': weather_cache['timestamp'].isoformat(),
+                'data': dict(timeline, times=timeline['times'].tolist(),
+                             params={name: values.tolist() for name, values in timeline['params'].items()}),
+                'location': weather_cache['location']
+            }
+        temp_filename = WEATHER_CACHE_FILE + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(stored, f)
+        os.replace(temp_filename, WEATHER_CACHE_FILE)
+        return True
+    except Exception as e:
+        print(f"Error saving weather cache: {str(e)}")
+        return False
+
+def refresh_weather_forecast():
+    """Fetch the SMHI forecast for Vänersborg into weather_cache"""
     current_location_coords = VANERSBORG_COORDS
     try:
-        if (weather_cache['data'] and
-            weather_cache['location'] == current_location_coords and
-            weather_cache['timestamp'] and
-            (datetime.now() - weather_cache['timestamp']).total_seconds() < 3600): # 1 hour cache
-            return weather_cache['data']
         lon, lat = map(float, current_location_coords.split(','))
         url = f"{SMHI_BASE_URL}/category/pmp3g/version/2/geotype/point/lon/{lon}/lat/{lat}/data.json"
         response = requests.get(url, timeout=10)
         response.raise_for_status()
-        forecast = response.json()
-        weather_cache.update({
-            'timestamp': datetime.now(),
-            'data': forecast,
-            'location': current_location_coords
-        })
-        return forecast
+        timeline = parse_smhi_forecast(response.json())
+        with weather_cache_lock:
+            weather_cache.update({
+                'timestamp': datetime.now(),
+                'data': timeline,
+                'location': current_location_coords,
+                'aligned': {},
+                'responses': {}
+            })
+        save_weather_cache()
+        # Serialize the full document now so no request has to
+        get_weather_response(('smhi',), lambda: weather_timeline_to_smhi(timeline))
     except Exception as e:
         print(f"Error fetching weather data: {str(e)}")
-        return None
+    finally:
+        with weather_cache_lock:
+            refreshing = weather_cache['refreshing']
+            weather_cache['refreshing'] = None
+        if refreshing:
+            refreshing.set()
+
+def start_weather_refresh():
+    """Start a background refresh unless one is already running or one failed recently.
+    Returns the Event of the running refresh, or None."""
+    with weather_cache_lock:
+        if weather_cache['refreshing'] is None:
+            last_attempt = weather_cache['last_attempt']
+            if last_attempt and (datetime.now() - last_attempt).total_seconds() < WEATHER_RETRY_DELAY:
+                return None
+            weather_cache['last_attempt'] = datetime.now()
+            weather_cache['refreshing'] = threading.Event()
+            threading.Thread(target=refresh_weather_forecast, daemon=True).start()
+        return weather_cache['refreshing']
+
+def get_weather_forecast(): # Modified: always Vänersborg, no args
+    """Return the parsed SMHI forecast timeline for Vänersborg. A stale forecast is returned right
+    away while it is refreshed in the background; callers only wait when there is
+    no forecast at all."""
+    current_location_coords = VANERSBORG_COORDS
+    if weather_cache['data'] and weather_cache['location'] == current_location_coords:
+        if (datetime.now() - weather_cache['timestamp']).total_seconds() >= WEATHER_CACHE_TTL: # 1 hour cache
+            start_weather_refresh()
+        return weather_cache['data']
+
+    # Nothing cached yet, wait for the (shared) refresh
+    refreshing = start_weather_refresh()
+    if refreshing:
+        refreshing.wait(15)
+    if weather_cache['data'] and weather_cache['location'] == current_location_coords:
+        return weather_cache['data']
+    return None
+
+load_weather_cache()
 
 @app.route('/api/weather')
 def api_weather(): # Modified: no location param
+    """SMHI forecast. Without parameters the full SMHI-style document is returned;
+    fields=t,ws and/or hours=48 return compact column arrays for just that part."""
     forecast = get_weather_forecast()
-    if forecast:
-        return jsonify(forecast)
-    return jsonify({"error": "Could not fetch weather data"}), 500
+    if not forecast:
+        return jsonify({"error": "Could not fetch weather data"}), 500
+
+    fields = request.args.get('fields')
+    hours = request.args.get('hours', type=int)
+    if fields is None and hours is None:
+        key = ('smhi',)
+        build = lambda: weather_timeline_to_smhi(forecast)
+    else:
+        names = [name for name in fields.split(',') if name] if fields else list(forecast['params'])
+        unknown = [name for name in names if name not in forecast['params']]
+        if unknown:
+            return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+        times = forecast['times']
+        now = int(time.time())
+        start_index = max(bisect_right(times, now) - 1, 0)
+        end_index = bisect_right(times, now + hours * 3600) if hours else len(times)
+        key = (tuple(names), start_index, end_index)
+        build = lambda: weather_projection(forecast, names, start_index, end_index)
+
+    body, gzipped = get_weather_response(key, build)
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = Response(gzipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(body, mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.route('/api/weather/aligned')
+def api_weather_aligned():
+    """Forecast outdoor temperature (or another parameter) interpolated onto the price slots"""
+    area = get_price_area_arg()
+    if area is None:
+        return jsonify({'error': f"area must be one of {', '.join(PRICE_AREAS_VALID)}"}), 400
+    name = request.args.get('param', default='t')
+    forecast = get_weather_forecast()
+    if forecast and name not in forecast['params']:
+        return jsonify({"error": f"Unknown param: {name}"}), 400
+    start, resolution, values = get_aligned_weather(name, area)
+    return jsonify({
+        'area': area,
+        'param': name,
+        'resolution_minutes': resolution // 60,
+        'time': [start + slot * resolution for slot in range(len(values))],
+        'values': [weather_value(value) for value in values]
+    })
 
 @app.route('/api/current-weather')
 def api_current_weather(): # Modified: no location param
-    forecast = get_weather_forecast()
-    if not forecast or 'timeSeries' not in forecast:
+    weather_data = get_current_weather()
+    if not weather_data:
         return jsonify({"error": "Could not fetch weather data"}), 500
-    try:
-        now_utc = datetime.utcnow() # Original now variable was fine
-        closest_forecast = None
-        min_diff = float('inf')
-        for forecast_point in forecast['timeSeries']:
-            forecast_time = datetime.strptime(forecast_point['validTime'], '%Y-%m-%dT%H:%M:%SZ')
-            # Both now_utc (naive UTC) and forecast_time (naive from strptime) are naive.
-            time_diff = abs((now_utc - forecast_time).total_seconds())
-            if time_diff < min_diff:
-                min_diff = time_diff
-                closest_forecast = forecast_point
-        if closest_forecast:
-            temp_param = next((p for p in closest_forecast['parameters'] if p['name'] == 't'), None)
-            temp = temp_param['values'][0] if temp_param else None
-            return jsonify({
-                'temperature': temp,
-                'time': closest_forecast['validTime'],
-                'location': 'Vänersborg' # Modified: always Vänersborg
-            })
-    except Exception as e:
-        print(f"Error processing weather data: {str(e)}")
-    return jsonify({"error": "Could not process weather data"}), 500
+    weather_data['location'] = 'Vänersborg' # Modified: always Vänersborg
+    return jsonify(weather_data)
+
+def get_price_area_arg():
+    """Read the bidding area from the query string, None if it is not valid"""
+    area = request.args.get('area', default=PRICE_AREA).upper()
+    return area if area in PRICE_AREAS_VALID else None
 
 @app.route('/api/prices')
 def api_prices():
-    current_prices = get_electricity_prices()
+    area = get_price_area_arg()
+    if area is None:
+        return jsonify({'error': f"area must be one of {', '.join(PRICE_AREAS_VALID)}"}), 400
+    current_prices = get_electricity_prices(area)
     return jsonify(current_prices)
 
+@app.route('/api/prices/cheapest')
+def api_prices_cheapest():
+    """The n cheapest hours and the cheapest consecutive window of hours"""
+    area = get_price_area_arg()
+    if area is None:
+        return jsonify({'error': f"area must be one of {', '.join(PRICE_AREAS_VALID)}"}), 400
+    n = request.args.get('n', default=PRICE_CHEAPEST_DEFAULTS['n'], type=int)
+    window = request.args.get('window', default=PRICE_CHEAPEST_DEFAULTS['window'], type=int)
+    horizon = request.args.get('horizon', default=PRICE_CHEAPEST_DEFAULTS['horizon'], type=int)
+    if n < 0 or window < 0 or horizon <= 0:
+        return jsonify({'error': 'n and window must be >= 0 and horizon > 0'}), 400
+    horizon = min(horizon, 48)
+
+    result = get_cheapest_prices(n, window, horizon, area=area)
+    return jsonify({
+        'area': area,
+        'n': n,
+        'window_hours': window,
+        'horizon_hours': horizon,
+        'resolution_minutes': result['resolution_minutes'],
+        'cheapest': result['cheapest'],
+        'window': result['window']
+    })
+
+@app.route('/api/prices/archive')
+def api_prices_archive():
+    """Archived prices for a date range as columns: slot start times (epoch seconds) and prices"""
+    area = get_price_area_arg()
+    if area is None:
+        return jsonify({'error': f"area must be one of {', '.join(PRICE_AREAS_VALID)}"}), 400
+    try:
+        today = datetime.now(pytz.timezone('Europe/Stockholm')).date()
+        end_date = datetime.strptime(request.args.get('to', today.isoformat()), '%Y-%m-%d').date()
+        start_date = datetime.strptime(request.args.get('from', end_date.isoformat()), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'from and to must be dates in YYYY-MM-DD format'}), 400
+    if start_date > end_date:
+        return jsonify({'error': 'from must not be after to'}), 400
+
+    times, prices = read_price_archive(area, start_date, end_date)
+    return jsonify({
+        'area': area,
+        'from': start_date.isoformat(),
+        'to': end_date.isoformat(),
+        'count': len(prices),
+        'time': times.tolist(),
+        'SEK_per_kWh': prices.tolist()
+    })
+
+@app.route('/api/prices/status')
+def api_prices_status():
+    """Status of the background price scheduler"""
+    def format_time(value):
+        return value.isoformat() if value else None
+
+    return jsonify({
+        'areas': {area: {
+            'date': format_time(state['date']),
+            'entries': len(state['series']['prices']),
+            'resolution_minutes': state['series']['resolution'] // 60,
+            'has_tomorrow': state['has_tomorrow']
+        } for area, state in price_states.items()},
+        'last_run': format_time(price_scheduler['last_run']),
+        'last_success': format_time(price_scheduler['last_success']),
+        'next_run': format_time(price_scheduler['next_run']),
+        'last_error': price_scheduler['last_error'],
+        'retry_delay': price_scheduler['retry_delay']
+    })
+
 @app.route('/api/mqtt/status')
 def mqtt_status():
     return jsonify({
@@ -851,13 +2923,7 @@ def handle_mqtt_message(client, userdata, message):
                         
                         # Get current electricity price
                         current_hour = datetime.now().hour
-                        electricity_price = None
-                        prices = get_electricity_prices()
-                        for price in prices:
-                            price_time = datetime.fromisoformat(price['time_start'].replace('Z', '+00:00'))
-                            if price_time.hour == current_hour and price_time.date() == datetime.now().date():
-                                electricity_price = price['SEK_per_kWh']
-                                break
+                        electricity_price = get_current_price()
                         
                         # Store hourly record
                         if current_hour != devices['shelly-roller'].get('last_recorded_hour', None):
@@ -898,28 +2964,20 @@ def handle_mqtt_message(client, userdata, message):
 
 # Helper function to get current weather
 def get_current_weather():
+    """Outdoor temperature interpolated to the current time, with the time of the
+    nearest forecast point"""
     forecast = get_weather_forecast()
-    if not forecast or 'timeSeries' not in forecast:
+    if not forecast:
         return None
     
     try:
-        now_utc = datetime.utcnow()
-        closest_forecast = None
-        min_diff = float('inf')
-        
-        for forecast_point in forecast['timeSeries']:
-            forecast_time = datetime.strptime(forecast_point['validTime'], '%Y-%m-%dT%H:%M:%SZ')
-            time_diff = abs((now_utc - forecast_time).total_seconds())
-            if time_diff < min_diff:
-                min_diff = time_diff
-                closest_forecast = forecast_point
-        
-        if closest_forecast:
-            temp_param = next((p for p in closest_forecast['parameters'] if p['name'] == 't'), None)
-            temp = temp_param['values'][0] if temp_param else None
+        now = time.time()
+        closest = weather_nearest_index(forecast, now)
+        if closest is not None:
+            temp = weather_interpolate(forecast, 't', now)
             return {
                 'temperature': temp,
-                'time': closest_forecast['validTime']
+                'time': format_smhi_time(forecast['times'][closest])
             }
     except Exception as e:
         print(f"Error processing weather data: {str(e)}")
@@ -1058,104 +3116,107 @@ def stop_roller_shutter():
         'message': 'Roller shutter stopped'
     })
 
+# Serialized history responses, keyed by the data versions and the request parameters
+history_responses = {}
+history_responses_lock = threading.Lock()
+
+def get_history_response(key, build):
+    """Return (etag, body bytes) for a history response, building it only once per
+    key. The key must contain everything the response depends on."""
+    with history_responses_lock:
+        cached = history_responses.get(key)
+    if cached is None:
+        body = build()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        cached = (hashlib.sha1(body).hexdigest()[:20], body)
+        with history_responses_lock:
+            if len(history_responses) > 64:
+                history_responses.clear()
+            history_responses[key] = cached
+    return cached
+
+def conditional_response(etag, body, mimetype):
+    """Response with an ETag, or 304 Not Modified if the client already has it"""
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    # Let browsers keep the response but check the ETag on every request
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/api/temperature/data', methods=['GET'])
 def get_temperature_data():
+    """Hourly records of the last days. With since=<cursor> only the records added
+    or changed after that cursor are returned; every response has a new cursor."""
     days = request.args.get('days', default=1, type=int)
-    records = data_storage.get_records(days=days)
+    # The record range starts at midnight days ago
+    first_day = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+    today = datetime.now().strftime("%Y-%m-%d")
     
-    # Calculate energy savings if we have enough data
-    if len(records) > 0:
+    def with_grid_consumption(records):
+        # Savings are stored with each record; grid_consumption is kept for older clients
         for record in records:
-            # Simple energy savings calculation based on temperature difference
-            # and whether the heat pump was in the optimal state
-            if 'indoor_temp' in record and 'outdoor_temp' in record and 'roller_position' in record:
-                indoor_temp = record.get('indoor_temp')
-                outdoor_temp = record.get('outdoor_temp')
-                heatpump_state = record.get('roller_position')  # Using roller_position field for heat pump state
-                electricity_price = record.get('electricity_price', 0)
-                
-                if indoor_temp is not None and outdoor_temp is not None:
-                    # Calculate temperature difference
-                    temp_diff = indoor_temp - outdoor_temp
-                    
-                    # Get solar production data (negative value means excess production/selling to grid)
-                    grid_consumption = record.get('solar_production', 0)
-                    
-                    # Determine optimal heat pump state based on temperatures, electricity price, and solar production
-                    optimal_state = None
-                    target_temp = 22  # Default target temperature
-                    
-                    # If we have excess solar production (negative grid consumption), use it!
-                    if grid_consumption < 0:  # We're producing more than consuming (selling to grid)
-                        optimal_state = 'on'  # Always turn on heat pump to use excess solar
-                        
-                        # If we have significant excess production, increase target temp to store more heat
-                        if grid_consumption < -1.0:  # More than 1kW excess
-                            target_temp = 24  # Store more heat
-                        elif grid_consumption < -2.0:  # More than 2kW excess
-                            target_temp = 25  # Store even more heat
-                    
-                    # If we're buying electricity (positive grid consumption), be more conservative
-                    else:
-                        # If it's cold inside (below 21°C), heat pump should be ON
-                        # unless electricity is very expensive
-                        if indoor_temp < 21:
-                            if electricity_price and electricity_price > 3.0:  # Very expensive electricity
-                                optimal_state = 'off'  # Turn off to save money
-                            else:
-                                optimal_state = 'on'   # Turn on to heat
-                        # If it's comfortable inside (21-23°C)
-                        elif 21 <= indoor_temp <= 23:
-                            if electricity_price and electricity_price > 2.0:  # Expensive electricity
-                                optimal_state = 'off'  # Turn off to save money
-                            else:
-                                optimal_state = 'on'   # Keep on for comfort
-                        # If it's warm inside (above target_temp)
-                        elif indoor_temp > target_temp:
-                            optimal_state = 'off'      # No need for heating
-                    
-                    # Calculate energy savings
-                    energy_saved = 0
-                    solar_benefit = 0
-                    
-                    # Record the target temperature for reference
-                    record['target_temp'] = target_temp
-                    
-                    if optimal_state and heatpump_state == optimal_state:
-                        if grid_consumption < 0:  # We're using excess solar production
-                            # Calculate benefit of using our own solar instead of selling to grid
-                            # Typically, selling price is lower than buying price (about 70% of buying price)
-                            solar_benefit = abs(grid_consumption) * electricity_price * 0.3  # The price difference
-                            energy_saved = solar_benefit
-                            
-                            # Add thermal storage benefit
-                            if indoor_temp > 22:  # We're storing heat above comfort temperature
-                                # Each degree above 22 represents stored thermal energy
-                                thermal_storage = (indoor_temp - 22) * 0.5  # kWh per degree of thermal mass
-                                energy_saved += thermal_storage
-                                
-                        elif optimal_state == 'off' and electricity_price:
-                            # If heat pump is correctly OFF when it should be, savings are based on electricity price
-                            # Assuming heat pump uses about 1.5 kWh per hour when running
-                            energy_saved = 1.5 * electricity_price
-                        elif optimal_state == 'on' and temp_diff < 0:
-                            # If heat pump is correctly ON when it's cold, savings are based on efficiency
-                            # Heat pumps are more efficient than direct electric heating (about 3x)
-                            # Assuming direct electric heating would use 3 kWh for the same heating
-                            energy_saved = 2.0  # kWh saved compared to direct electric heating
-                    
-                    # Add solar production info to the record
-                    record['grid_consumption'] = grid_consumption
-                    record['solar_benefit'] = round(solar_benefit, 2)
-                    
-                    # Add energy savings to the record
-                    record['energy_saved'] = round(energy_saved, 2)
-                    record['optimal_state'] = optimal_state
+            if record['energy_saved'] is not None:
+                record['grid_consumption'] = record['solar_production']
+        return records
+    
+    since = request.args.get('since')
+    if since:
+        changes = data_storage.get_changes(since, first_day)
+        if changes is not None:
+            records, cursor = changes
+            return jsonify({
+                'records': with_grid_consumption(records),
+                'total_records': len(records),
+                'days_requested': days,
+                'delta': True,
+                'cursor': cursor,
+                'window_start': first_day,
+                'totals': data_storage.get_totals(first_day, today)
+            })
+        # Unknown cursor, fall through to a full response
+    
+    cursor = data_storage.get_cursor()
     
+    def build():
+        records = with_grid_consumption(data_storage.get_records(days=days))
+        return json.dumps({
+            'records': records,
+            'total_records': len(records),
+            'days_requested': days,
+            'delta': False,
+            'cursor': cursor,
+            'window_start': first_day,
+            'totals': data_storage.get_totals(first_day, today)
+        }, separators=(',', ':'))
+    
+    # Only the stored history, telemetry changes with every sample and has its own endpoint
+    key = ('temperature-data', cursor, first_day, days)
+    etag, body = get_history_response(key, build)
+    return conditional_response(etag, body, 'application/json')
+
+@app.route('/api/telemetry', methods=['GET'])
+def get_telemetry():
+    """Telemetry of the last days as columns, from the finest tier that fits unless
+    tier is given. metrics limits the result to some metrics (comma separated)."""
+    days = request.args.get('days', default=1, type=float)
+    metrics = [metric.strip() for metric in request.args.get('metrics', ','.join(TELEMETRY_METRICS)).split(',') if metric.strip()]
+    if not metrics or any(metric not in TELEMETRY_METRICS for metric in metrics):
+        return jsonify({'error': f"metrics must be some of {', '.join(TELEMETRY_METRICS)}"}), 400
+    end = time.time()
+    start = end - days * 86400
+    tier = request.args.get('tier')
+    if tier is not None and tier not in [name for name, resolution, retention in TELEMETRY_TIERS]:
+        return jsonify({'error': f"tier must be one of {', '.join(name for name, resolution, retention in TELEMETRY_TIERS)}"}), 400
+    if tier is None:
+        tier = telemetry_store.select_tier(start, end)
     return jsonify({
-        'records': records,
-        'total_records': len(records),
-        'days_requested': days
+        'tier': tier,
+        'resolution_seconds': next(resolution for name, resolution, retention in TELEMETRY_TIERS if name == tier),
+        'columns': telemetry_store.get_columns(tier, start, end, metrics)
     })
 
 @app.route('/api/solar/update', methods=['POST'])
@@ -1202,9 +3263,11 @@ def temperature_dashboard():
     # Get the latest 24 hours of data
     records = data_storage.get_records(days=1)
     
-    # Calculate total energy saved
-    total_energy_saved = sum(record.get('energy_saved', 0) for record in records)
-    total_solar_benefit = sum(record.get('solar_benefit', 0) for record in records)
+    # Totals over the same days, from the running aggregates
+    now = datetime.now()
+    totals = data_storage.get_totals((now - timedelta(days=1)).strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d"))
+    total_energy_saved = totals['energy_saved']
+    total_solar_benefit = totals['solar_benefit']
     
     # Fetch the latest data from sensors and meters
     fetch_indoor_sensor_data()
@@ -1244,26 +3307,157 @@ def temperature_dashboard():
         devices=devices  # Pass the entire devices dictionary to access all sensor data
     )
 
+@app.route('/api/storage/metrics')
+def storage_metrics():
+    """Write-behind metrics of the history storage"""
+    return jsonify(data_storage.get_metrics())
+
+def get_history_range_args():
+    """Read from/to as dates or local timestamps. A date in to includes that whole day.
+    Returns (start, end) timestamp strings, None for open ends; raises ValueError."""
+    start = request.args.get('from') or None
+    end = request.args.get('to') or None
+    if start:
+        start = history_timestamp(history_time(start))
+    if end:
+        end_seconds = history_time(end)
+        if len(end) == 10:
+            end_seconds += 86400
+        end = history_timestamp(end_seconds)
+    return start, end
+
+@app.route('/api/history/export')
+def export_history():
+    """Stream history rows as CSV or NDJSON, one chunk of rows at a time"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    try:
+        start, end = get_history_range_args()
+    except ValueError:
+        return jsonify({'error': 'from and to must be dates (YYYY-MM-DD) or timestamps (YYYY-MM-DD HH:MM:SS)'}), 400
+    
+    def generate():
+        if export_format == 'csv':
+            yield ','.join(HISTORY_FIELDS) + '\r\n'
+        for chunk in data_storage.iter_columns(start, end):
+            buffer = io.StringIO()
+            if export_format == 'csv':
+                writer = csv.DictWriter(buffer, fieldnames=HISTORY_FIELDS)
+                writer.writerows(history_rows(chunk))
+            else:
+                for row in history_rows(chunk):
+                    buffer.write(json.dumps(row) + '\n')
+            yield buffer.getvalue()
+    
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(generate(), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=history.{export_format}'
+    })
+
+@app.cli.command('recompute-savings')
+def recompute_history_savings():
+    """Recompute the stored savings fields after the savings policy has changed.
+    Run it with `flask --app app recompute-savings` while the app is stopped."""
+    started = time.perf_counter()
+    hot_count, archived_count = data_storage.recompute_savings()
+    # stdout goes to the log file, the summary is for the terminal
+    print(f"Recomputed savings for {hot_count} records and {archived_count} archived records "
+          f"in {time.perf_counter() - started:.3f} seconds", file=sys.__stdout__)
+
+@app.route('/api/history/query')
+def query_history():
+    """History for a time range as columns, optionally aggregated into buckets.
+    Parameters: from, to, fields (comma separated), bucket (15m, 1h, 1d) and
+    agg (mean, min, max, sum, last; default mean)."""
+    try:
+        start, end = get_history_range_args()
+    except ValueError:
+        return jsonify({'error': 'from and to must be dates (YYYY-MM-DD) or timestamps (YYYY-MM-DD HH:MM:SS)'}), 400
+    value_fields = HISTORY_FIELDS[1:]
+    fields = [field.strip() for field in request.args.get('fields', ','.join(value_fields)).split(',') if field.strip()]
+    unknown = [field for field in fields if field not in value_fields]
+    if unknown or not fields:
+        return jsonify({'error': f"fields must be some of {', '.join(value_fields)}"}), 400
+    bucket = request.args.get('bucket')
+    if bucket is not None and bucket not in HISTORY_BUCKETS:
+        return jsonify({'error': f"bucket must be one of {', '.join(HISTORY_BUCKETS)}"}), 400
+    agg = request.args.get('agg', 'mean')
+    if agg not in HISTORY_AGGREGATES:
+        return jsonify({'error': f"agg must be one of {', '.join(HISTORY_AGGREGATES)}"}), 400
+    
+    columns = data_storage.get_columns(start, end, fields)
+    if bucket:
+        result = aggregate_history(columns, fields, HISTORY_BUCKETS[bucket], agg)
+    else:
+        rows = history_rows(columns)
+        result = {name: [row[name] for row in rows] for name in ['timestamp'] + fields}
+        result['time'] = result.pop('timestamp')
+    
+    return jsonify({
+        'from': start,
+        'to': end,
+        'bucket': bucket,
+        'agg': agg if bucket else None,
+        'count': len(result['time']),
+        'columns': result
+    })
+
+@app.route('/api/history/totals')
+def history_totals():
+    """Energy saved, solar benefit, heat pump on-hours, average temperatures and cost
+    per day or month from the running aggregates. Parameters: from, to (dates,
+    default the last 30 days) and by (day or month, default day)."""
+    by = request.args.get('by', 'day')
+    if by not in ('day', 'month'):
+        return jsonify({'error': 'by must be day or month'}), 400
+    now = datetime.now()
+    start_day = request.args.get('from') or (now - timedelta(days=30)).strftime("%Y-%m-%d")
+    end_day = request.args.get('to') or now.strftime("%Y-%m-%d")
+    try:
+        datetime.strptime(start_day, "%Y-%m-%d")
+        datetime.strptime(end_day, "%Y-%m-%d")
+    except ValueError:
+        return jsonify({'error': 'from and to must be dates (YYYY-MM-DD)'}), 400
+    
+    return jsonify({
+        'from': start_day,
+        'to': end_day,
+        'by': by,
+        'periods': [format_aggregate(period, aggregate)
+                    for period, aggregate in data_storage.get_aggregates(start_day, end_day, by)],
+        'total': data_storage.get_totals(start_day, end_day)
+    })
+
 @app.route('/history')
 def history_view():
     # Get days parameter from query string, default to 7
     days = request.args.get('days', default=7, type=int)
     
-    # Get the historical records
-    records = data_storage.get_records(days=days)
+    # Render the historical records once per version of the data
+    first_day = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+    key = ('history', data_storage.version, first_day, days)
+    etag, body = get_history_response(key, lambda: render_template(
+        'history.html',
+        records=data_storage.get_records(days=days),
+        days=days,
+        data_filename=os.path.abspath(data_storage.filename)
+    ))
     
     # Record current data to ensure we have the latest
     record_current_data()
     
-    # Get the filename where data is stored
-    data_filename = os.path.abspath(data_storage.filename)
-    
-    return render_template(
-        'history.html',
-        records=records,
-        days=days,
-        data_filename=data_filename
-    )
+    return conditional_response(etag, body, 'text/html')
+
+def shutdown(signum, frame):
+    """Write pending history and the telemetry rollups, then exit right away"""
+    print("Shutting down, saving history and telemetry")
+    try:
+        data_storage.close()
+        telemetry_store.save()
+    finally:
+        os._exit(0)
 
 if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, shutdown)
     app.run(host='0.0.0.0', port=8080, debug=False)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Savings Benchmark
+Compares the per-record savings policy with the vectorized numpy version on
+random history columns, checks that both give bit-for-bit identical results
+and prints the time each takes.
+"""
+
+import argparse
+import sys
+import time
+from savings import np, calculate_savings, calculate_savings_columns
+
+if np is None:
+    sys.exit("The benchmark needs numpy: pip install numpy (or pip install -r requirements.txt)")
+
+SAVINGS_FIELDS = ['target_temp', 'optimal_state', 'energy_saved', 'solar_benefit']
+
+def make_columns(rows, seed):
+    """Random history columns, rounded to float32 like the stored history"""
+    rng = np.random.default_rng(seed)
+
+    def stored(values, missing=0.02):
+        values = values.astype(np.float32).astype(np.float64)
+        values[rng.random(rows) < missing] = np.nan
+        return values
+
+    prices = np.round(rng.uniform(-0.5, 4.0, rows), 4)
+    # Include prices exactly on the policy thresholds
+    special = rng.random(rows)
+    prices[special < 0.05] = 0.0
+    prices[(special >= 0.05) & (special < 0.1)] = 2.0
+    prices[(special >= 0.1) & (special < 0.15)] = 3.0
+    grid = np.round(rng.uniform(-3.0, 2.0, rows), 3)
+    grid[rng.random(rows) < 0.4] = 0.0
+    states = np.array(['on', 'off', 'open', 'closed', None], dtype=object)
+    return {
+        'indoor_temp': stored(np.round(rng.uniform(18.0, 26.0, rows), 1)),
+        'outdoor_temp': stored(np.round(rng.uniform(-15.0, 30.0, rows), 1)),
+        'heatpump_state': states[rng.integers(0, len(states), rows)],
+        'electricity_price': stored(prices),
+        'grid_consumption': stored(grid)
+    }
+
+def run_scalar(columns):
+    """calculate_savings for every row, with None for missing values"""
+    def values(name):
+        return [None if value != value else value for value in columns[name].tolist()]
+
+    results = {field: [] for field in SAVINGS_FIELDS}
+    for row in zip(values('indoor_temp'), values('outdoor_temp'), columns['heatpump_state'].tolist(),
+                   values('electricity_price'), values('grid_consumption')):
+        savings = calculate_savings(*row) or (None, None, None, None)
+        for field, value in zip(SAVINGS_FIELDS, savings):
+            results[field].append(value)
+    return results
+
+def identical(scalar, vectorized):
+    for field in SAVINGS_FIELDS:
+        if field == 'optimal_state':
+            if scalar[field] != vectorized[field].tolist():
+                return False
+            continue
+        expected = np.array([np.nan if value is None else value for value in scalar[field]], dtype=np.float64)
+        if not np.array_equal(expected.view(np.int64), vectorized[field].view(np.int64)):
+            return False
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the savings policy')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Comma separated row counts')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per size, the best time is shown')
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'scalar ms':>10} {'numpy ms':>10} {'speedup':>8}  identical")
+    for size in [int(value) for value in args.sizes.split(',')]:
+        columns = make_columns(size, seed=size)
+        scalar_times = []
+        vector_times = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            scalar = run_scalar(columns)
+            scalar_times.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            vectorized = calculate_savings_columns(columns['indoor_temp'], columns['outdoor_temp'],
+                                                   columns['heatpump_state'], columns['electricity_price'],
+                                                   columns['grid_consumption'])
+            vector_times.append(time.perf_counter() - started)
+        scalar_ms = min(scalar_times) * 1000
+        vector_ms = min(vector_times) * 1000
+        print(f"{size:>8} {scalar_ms:>10.2f} {vector_ms:>10.2f} {scalar_ms / vector_ms:>7.1f}x  "
+              f"{'yes' if identical(scalar, vectorized) else 'NO'}")
+
+if __name__ == '__main__':
+    main()